@@ -0,0 +1,413 @@
+"""
+Local stand-ins for the Scoro JSON API and the ClearBooks SOAP endpoint, so
+the sync can be measured without touching production accounts.
+
+Both servers take a per-request latency, an error rate (answered with a 503),
+an optional rate limit (answered with a 429 and Retry-After) and the size of
+the generated dataset. Tests can also queue faults for the next requests.
+"""
+import re
+import json
+import time
+import random
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from xml.sax.saxutils import escape, quoteattr
+
+
+SOAP_NS = (
+    'xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:ns1="https://secure.clearbooks.co.uk/api/accounting/soap/"')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body go out in separate writes; don't let Nagle delay them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _body(self):
+        length = self.headers.get("Content-Length")
+        if length:
+            return self.rfile.read(int(length))
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return b""
+
+    def reply(self, status, body, content_type, headers=None):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self._body()
+        fake = self.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.over_limit():
+            fake.count("throttled")
+            return self.reply(
+                429, "Too many requests", "text/plain", {"Retry-After": "1"})
+        if fake.error_rate and fake.random.random() < fake.error_rate:
+            fake.count("error")
+            return self.reply(503, "Service unavailable", "text/plain")
+        fault = fake.next_fault()
+        if fault not in (None, "timeout"):
+            fake.count("fault")
+            return self.reply(
+                fault, "Injected fault", "text/plain", {"Retry-After": "0"})
+        status, content_type, text = fake.handle(self.path, self.headers, body)
+        if fault == "timeout":
+            # The request was acted on, but the answer comes too late
+            fake.count("fault")
+            time.sleep(fake.stall)
+        self.reply(status, text, content_type)
+
+
+class FakeServer(object):
+    """
+    Base for the fake APIs: runs a threaded HTTP server on a free local port.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=None, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._window = (0, 0)
+        self.random = random.Random(seed)
+        self.calls = {}
+        # Statuses to answer the next requests with, in order, or "timeout"
+        # to handle a request but answer only after `stall` seconds
+        self.faults = []
+        self.stall = 1.0
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def next_fault(self):
+        with self._lock:
+            return self.faults.pop(0) if self.faults else None
+
+    def over_limit(self):
+        """
+        Count a call against the current one-second window.
+        """
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            second, calls = self._window
+            now = int(time.time())
+            if now != second:
+                second, calls = now, 0
+            self._window = (second, calls + 1)
+            return calls >= self.rate_limit
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self.server = _Server(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+
+class FakeScoro(FakeServer):
+    """
+    The parts of the Scoro API used by the sync: invoices, contacts, projects,
+    products, productGroups and financeObjects.
+    """
+    def __init__(self, invoices=100, lines=3, contacts=50, projects=20,
+                 products=100, groups=10, finance_objects=10, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        # Calls such as "invoices/modify" to answer with an error status
+        self.failing = set()
+        self.contacts = contacts
+        self.projects = projects
+        self.products = products
+        self.groups = groups
+        self.finance_objects = finance_objects
+        self.lines = lines
+        self.invoices = {}
+        self.add_invoices(invoices, modified="2016-12-31 18:00:00")
+
+    def add_invoices(self, count, modified=None):
+        """
+        Add unpaid invoices, last modified at `modified` or now.
+        """
+        modified = modified or time.strftime("%Y-%m-%d %H:%M:%S")
+        lines, products = self.lines, self.products
+        contacts, projects = self.contacts, self.projects
+        finance_objects = self.finance_objects
+        start = len(self.invoices) + 1
+        for i in range(start, start + count):
+            self.invoices[i] = {
+                "id": i,
+                "no": 10000 + i,
+                "date": "2016-{:02d}-{:02d}".format(10 + i % 3, 1 + i % 28),
+                "deadline": "2017-01-31",
+                "modified_date": modified,
+                "company_id": 1 + i % contacts,
+                "project_id": str(i % (projects + 1)),
+                "description": "Services & support #{}".format(i),
+                "discount": "0",
+                "sum": "{:.2f}".format(lines * 50.0),
+                "custom_fields": {
+                    "c_clearbooksref": "",
+                    "c_ponumber": "PO-{:06d}".format(i),
+                    "c_accountmanager": "Account manager {}".format(i % 7),
+                    "c_notes": "Invoice terms and delivery notes for order {}, "
+                               "agreed with the customer.".format(i),
+                },
+                "lines": [{
+                    "product_id": str(1 + (i * lines + j) % products),
+                    "amount": "1.000000",
+                    "price": "50.00",
+                    "sum": "50.00",
+                    "vat": "20",
+                    "finance_object_id": 1 + j % finance_objects,
+                    "finance_account_id": 0,
+                    "comment": "Line {}".format(j),
+                } for j in range(lines)],
+            }
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}/api/v2/".format(self.port)
+
+    def transferred(self):
+        return sum(
+            1 for i in self.invoices.values() if i["custom_fields"]["c_clearbooksref"])
+
+    def handle(self, path, headers, body):
+        parts = path.split("/api/v2/", 1)[-1].strip("/").split("/")
+        method = parts[0]
+        action = parts[1] if len(parts) > 1 else "list"
+        record_id = parts[2] if len(parts) > 2 else None
+        request = json.loads(body.decode("utf-8") or "{}")
+        self.count("{}/{}".format(method, action))
+
+        handler = getattr(self, "_{}_{}".format(method, action), None)
+        if "{}/{}".format(method, action) in self.failing:
+            data = {"status": "ERROR", "message": "Rejected {}".format(path)}
+        elif handler is None:
+            data = {"status": "ERROR", "message": "Unknown call {}".format(path)}
+        else:
+            data = {"status": "OK", "data": handler(record_id, request)}
+        return 200, "application/json", json.dumps(data)
+
+    def _page(self, records, request):
+        page = int(request.get("page", 1))
+        per_page = int(request.get("per_page", 40))
+        return records[(page - 1) * per_page:page * per_page]
+
+    def _invoices_list(self, record_id, request):
+        filters = request.get("filter", {})
+        wanted = filters.get("custom_fields", {})
+        since = {
+            field: filters[field]["from"] for field in ("date", "modified_date")
+            if "from" in filters.get(field, {})}
+        records = [
+            {"id": i["id"], "no": i["no"], "date": i["date"]}
+            for i in self.invoices.values()
+            if all(i["custom_fields"].get(k) == v for k, v in wanted.items())
+            and all(i[field] >= value for field, value in since.items())]
+        return self._page(records, request)
+
+    def _invoices_view(self, record_id, request):
+        return self.invoices[int(record_id)]
+
+    def _invoices_modify(self, record_id, request):
+        invoice = self.invoices[int(record_id)]
+        changes = request.get("request", {})
+        invoice["custom_fields"].update(changes.get("custom_fields", {}))
+        invoice["modified_date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        return {"id": invoice["id"]}
+
+    def _contacts_view(self, record_id, request):
+        contact_id = int(record_id)
+        return {
+            "contact_id": contact_id,
+            "contact_type": "company",
+            "name": "Customer &amp; Co {}".format(contact_id),
+            "addresses": [{
+                "street": "Unit {}\r\n1 High Street\r\nIndustrial Estate".format(contact_id),
+                "city": "Leeds",
+                "county": "West Yorkshire",
+                "country": "GBR",
+                "zipcode": "LS1 1AA",
+                "contact_id": contact_id,
+            }],
+            "means_of_contact": {
+                "email": ["accounts{}@example.com".format(contact_id)],
+                "phone": ["0113 000 0000"],
+            },
+        }
+
+    def _contacts_list(self, record_id, request):
+        return self._page(
+            [self._contacts_view(c, request) for c in range(1, self.contacts + 1)],
+            request)
+
+    def _projects_view(self, record_id, request):
+        return {"project_name": "PRJ{}".format(record_id), "description": "Project"}
+
+    def _projects_list(self, record_id, request):
+        return self._page([
+            dict(self._projects_view(p, request), project_id=p)
+            for p in range(1, self.projects + 1)], request)
+
+    def _product(self, product_id):
+        return {
+            "product_id": product_id,
+            "name": "Product {}".format(product_id),
+            "productgroup_id": str(1 + product_id % self.groups),
+        }
+
+    def _products_view(self, record_id, request):
+        return self._product(int(record_id))
+
+    def _products_list(self, record_id, request):
+        return self._page(
+            [self._product(p) for p in range(1, self.products + 1)], request)
+
+    def _productGroups_view(self, record_id, request):
+        return {"productgroup_id": int(record_id), "name": "Group {}".format(record_id)}
+
+    def _productGroups_list(self, record_id, request):
+        return self._page([
+            {"productgroup_id": g, "name": "Group {}".format(g)}
+            for g in range(1, self.groups + 1)], request)
+
+    def _financeObjects_view(self, record_id, request):
+        return {"object_id": int(record_id), "name": "Sales {}".format(record_id)}
+
+    def _financeObjects_list(self, record_id, request):
+        return self._page([
+            {"object_id": f, "name": "Sales {}".format(f)}
+            for f in range(1, self.finance_objects + 1)], request)
+
+
+class FakeClearBooks(FakeServer):
+    """
+    The ClearBooks SOAP calls used by the sync.
+    """
+    def __init__(self, customers=20, account_codes=10, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.entities = {
+            c: {"company_name": "Customer & Co {}".format(c), "external_id": str(c)}
+            for c in range(1, customers + 1)}
+        self.account_codes = account_codes
+        self.invoices = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api/soap/".format(self.port)
+
+    def handle(self, path, headers, body):
+        body = body.decode("utf-8")
+        actions = re.findall(r"<ns1:(create\w+|list\w+)>", body)
+        if not actions:
+            actions = [headers.get("SOAPAction", "").rsplit("#", 1)[-1]]
+
+        # Several operations may share one envelope; answer each in turn
+        results = []
+        for n, action in enumerate(actions):
+            self.count(action)
+            handler = getattr(self, "_" + action, None)
+            if handler is None:
+                return 500, "text/xml", self._envelope(
+                    "<SOAP-ENV:Fault><faultstring>Unknown action {}</faultstring>"
+                    "</SOAP-ENV:Fault>".format(escape(action)))
+            results.append(handler(body, n))
+        return 200, "text/xml", self._envelope("".join(results))
+
+    def _envelope(self, body):
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?><SOAP-ENV:Envelope {}>'
+            '<SOAP-ENV:Body>{}</SOAP-ENV:Body></SOAP-ENV:Envelope>'.format(SOAP_NS, body))
+
+    def _attribute(self, body, name, n):
+        values = re.findall(r'\b{}="([^"]*)"'.format(name), body)
+        return values[n] if n < len(values) else ""
+
+    def _listEntities(self, body, n):
+        entities = "".join(
+            '<ns1:Entity id="{}" company_name={} external_id={}/>'.format(
+                c, quoteattr(e["company_name"]), quoteattr(e["external_id"]))
+            for c, e in self.entities.items())
+        return "<ns1:listEntitiesResponse><return>{}</return></ns1:listEntitiesResponse>".format(
+            entities)
+
+    def _listAccountCodes(self, body, n):
+        codes = "".join(
+            '<ns1:AccountCode id="{}" account_name="Sales {}"/>'.format(4000 + a, a)
+            for a in range(1, self.account_codes + 1))
+        return "<ns1:listAccountCodesResponse><return>{}</return></ns1:listAccountCodesResponse>".format(
+            codes)
+
+    def _listInvoices(self, body, n):
+        invoices = "".join(
+            '<ns1:Invoice invoice_id="{}" invoice_prefix={} invoiceNumber={} '
+            'entityId={} reference={}/>'.format(
+                i["invoice_id"], quoteattr(i.get("invoice_prefix", "INV")),
+                quoteattr(i["invoice_number"]),
+                quoteattr(i["entity_id"]), quoteattr(i["reference"]))
+            for i in self.invoices)
+        return "<ns1:listInvoicesResponse><return>{}</return></ns1:listInvoicesResponse>".format(
+            invoices)
+
+    def _createEntity(self, body, n):
+        entity_id = len(self.entities) + 1
+        self.entities[entity_id] = {
+            "company_name": self._attribute(body, "company_name", n),
+            "external_id": self._attribute(body, "external_id", n),
+        }
+        return ("<ns1:createEntityResponse><createEntityReturn>{}</createEntityReturn>"
+                "</ns1:createEntityResponse>".format(entity_id))
+
+    def _createInvoice(self, body, n):
+        references = re.findall(r"<reference>([^<]*)</reference>", body)
+        invoice = {
+            "invoice_id": str(len(self.invoices) + 1),
+            "invoice_number": self._attribute(body, "invoice_number", n),
+            "entity_id": self._attribute(body, "entityId", n),
+            "reference": references[n] if n < len(references) else "",
+        }
+        self.invoices.append(invoice)
+        return ('<ns1:createInvoiceResponse><createInvoiceReturn invoice_id="{}" '
+                'invoice_prefix="INV" invoice_number={}/></ns1:createInvoiceResponse>'.format(
+                    invoice["invoice_id"], quoteattr(invoice["invoice_number"])))
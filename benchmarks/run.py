@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Benchmark run_sync against the local Scoro and ClearBooks stand-ins.
+
+    python -m benchmarks.run --sizes 100,1000,10000 --latency 0.005
+
+Each size is synced in a fresh child process, so the peak memory reported is
+that of the sync alone. The report gives the throughput, p50/p99 latency of
+each stage and API call, and the peak resident memory. With --incremental N,
+N new invoices are then added and synced again from the checkpoint.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from benchmarks.fakes import FakeScoro, FakeClearBooks
+
+
+def child():
+    """
+    Run one sync with the environment set up by the parent and print the
+    measurements as JSON.
+    """
+    if os.environ.get("SYNC_ASYNC") == "1":
+        from scoro2clearbooks.aio import run_sync
+    else:
+        from scoro2clearbooks.utils import run_sync
+    from scoro2clearbooks.metrics import metrics
+
+    # The histogram buckets are too coarse to compare runs, so keep every
+    # timing as well
+    samples = {}
+    observe = metrics.observe
+
+    def keep(name, seconds, **labels):
+        key = "{} {}".format(name, ",".join(str(v) for k, v in sorted(labels.items())))
+        samples.setdefault(key.strip(), []).append(seconds)
+        observe(name, seconds, **labels)
+    metrics.observe = keep
+
+    start = time.time()
+    errors = run_sync()
+    elapsed = time.time() - start
+
+    timings = {}
+    for name, values in samples.items():
+        values.sort()
+        timings[name] = {
+            "count": len(values),
+            "sum": sum(values),
+            "p50": percentile(values, 0.5),
+            "p99": percentile(values, 0.99),
+        }
+    sent = {}
+    for (name, labels), value in metrics.counters.items():
+        if name.endswith("_bytes_sent_total"):
+            sent[",".join(str(v) for k, v in labels)] = value
+
+    print(json.dumps({
+        "elapsed": elapsed,
+        "errors": len(errors),
+        "timings": timings,
+        "bytes_sent": sent,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }))
+
+
+def percentile(values, q):
+    """
+    The q-th quantile of sorted values, interpolating between the two
+    nearest.
+    """
+    rank = q * (len(values) - 1)
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def bench(size, args):
+    scoro = FakeScoro(
+        invoices=size, lines=args.lines, latency=args.latency,
+        error_rate=args.error_rate, rate_limit=args.rate_limit).start()
+    clearbooks = FakeClearBooks(
+        latency=args.latency, error_rate=args.error_rate,
+        rate_limit=args.rate_limit).start()
+    cache = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    cache.close()
+
+    env = dict(os.environ)
+    env.update({
+        "SCORO_BASE_URL": scoro.base_url,
+        "CLEARBOOKS_URL": clearbooks.url,
+        "SYNC_CACHE_PATH": cache.name,
+        "SYNC_WORKERS": str(args.workers),
+        "SCORO_CONCURRENCY": str(args.concurrency),
+        "CLEARBOOKS_CONCURRENCY": str(args.concurrency),
+        "SCORO_RATE": str(args.rate),
+        "CLEARBOOKS_RATE": str(args.rate),
+        "SYNC_ASYNC": "1" if args.use_async else "0",
+    })
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+
+    def run(label):
+        scoro.calls, clearbooks.calls = {}, {}
+        transferred = scoro.transferred()
+        output = subprocess.check_output(
+            [sys.executable, "-m", "benchmarks.run", "--child"], env=env,
+            stderr=subprocess.DEVNULL if not args.verbose else None)
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        result["size"] = label
+        result["transferred"] = scoro.transferred() - transferred
+        result["calls"] = dict(scoro.calls, **clearbooks.calls)
+        return result
+
+    try:
+        results = [run(size)]
+        if args.incremental:
+            # Only the new invoices are listed, as modified since the first run
+            scoro.add_invoices(args.incremental)
+            results.append(run("{} new of {}".format(args.incremental, size)))
+    finally:
+        scoro.stop()
+        clearbooks.stop()
+        for suffix in ("", "-wal", "-shm", ".lock"):
+            if os.path.exists(cache.name + suffix):
+                os.remove(cache.name + suffix)
+    return results
+
+
+def report(result):
+    lines = [
+        "== {size} invoices: {transferred} transferred, {errors} errors ==".format(**result),
+        "elapsed {:.2f}s, {:.1f} invoices/s, peak memory {:.1f} MB".format(
+            result["elapsed"], result["transferred"] / max(result["elapsed"], 1e-9),
+            result["peak_rss_mb"]),
+        "{:<55} {:>7} {:>9} {:>9}".format("stage / call", "count", "p50 ms", "p99 ms"),
+    ]
+    for name, t in sorted(result["timings"].items()):
+        lines.append("{:<55} {:>7} {:>9.1f} {:>9.1f}".format(
+            name, t["count"], t["p50"] * 1000, t["p99"] * 1000))
+    lines.append("bytes sent:")
+    for name, value in sorted(result["bytes_sent"].items()):
+        calls = result["timings"].get(
+            "scoro_request_seconds {}".format(name),
+            result["timings"].get("clearbooks_request_seconds {}".format(name), {}))
+        per_call = value / calls["count"] if calls.get("count") else 0
+        lines.append("  {:<45} {:>12} total {:>9.0f} per call".format(
+            name, value, per_call))
+    first = result["timings"].get("sync_first_invoice_seconds")
+    if first:
+        loads = sorted(
+            (name.split(" ", 1)[1], t["sum"]) for name, t in result["timings"].items()
+            if name.startswith("sync_startup_seconds "))
+        lines.append("first invoice after {:.2f}s; startup loads: {}".format(
+            first["sum"], ", ".join("{} {:.2f}s".format(n, s) for n, s in loads)))
+    writes = result["timings"].get("scoro_request_seconds modify,invoices")
+    if writes:
+        lines.append(
+            "write-back: {:.0f} bytes per invoice, p50 {:.1f} ms, p99 {:.1f} ms".format(
+                result["bytes_sent"].get("modify,invoices", 0) / writes["count"],
+                writes["p50"] * 1000, writes["p99"] * 1000))
+    lines.append("API calls: {}".format(json.dumps(result["calls"], sort_keys=True)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated invoice counts")
+    parser.add_argument("--lines", type=int, default=3, help="lines per invoice")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds added to each fake API call")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of fake API calls that fail with a 503")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="calls per second each fake API allows before a 429")
+    parser.add_argument("--rate", type=float, default=1000.0,
+                        help="calls per second the sync may make to each API")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="calls in flight per API")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the asyncio sync; --workers is then invoices in flight")
+    parser.add_argument("--incremental", type=int, default=0,
+                        help="then add this many invoices and sync again")
+    parser.add_argument("--env", action="append", default=[],
+                        help="extra NAME=value settings for the sync")
+    parser.add_argument("--json", action="store_true", help="print raw results")
+    parser.add_argument("--verbose", action="store_true", help="show the sync log")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child()
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for result in bench(size, args):
+            print(json.dumps(result) if args.json else report(result))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
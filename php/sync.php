@@ -2,7 +2,18 @@
 
 $url = "http://example.com/sync";
 
+// Start the sync, then poll the job until it has finished
 $response = file_get_contents($url);
 print_r($response . "\n");
 
+if (preg_match('/: ([0-9a-f]+)/', $response, $matches)) {
+    do {
+        sleep(10);
+        $job = json_decode(file_get_contents($url . "/" . $matches[1]), true);
+        print_r($job["status"] . " " . $job["done"] . "/" . $job["total"] . "\n");
+    } while ($job["status"] == "queued" || $job["status"] == "running");
+
+    print_r($job["summary"] . "\n");
+}
+
 ?>
@@ -1,11 +1,48 @@
+import os
+import hmac
 import logging
+import threading
 
-from flask import Flask
+from flask import Flask, Response, jsonify, request
 from scoro2clearbooks.utils import run_sync
+from scoro2clearbooks.jobs import JobQueue
+from scoro2clearbooks.metrics import SharedMetrics, metrics
+from scoro2clearbooks.webhooks import EventQueue, WebhookWorker, invoice_event
 
 
 app = Flask(__name__)
 
+# The job queue and webhook worker open the sync database, so they are only
+# made on first use; importing the package, e.g. from sync.py, leaves it alone
+_lock = threading.Lock()
+_jobs = None
+_webhooks = None
+_shared_metrics = None
+
+
+def get_jobs():
+    global _jobs
+    with _lock:
+        if _jobs is None:
+            _jobs = JobQueue(run_sync, path=os.environ.get("SYNC_CACHE_PATH"))
+        return _jobs
+
+
+def get_webhooks():
+    global _webhooks
+    with _lock:
+        if _webhooks is None:
+            _webhooks = WebhookWorker(EventQueue(path=os.environ.get("SYNC_CACHE_PATH")))
+        return _webhooks
+
+
+def get_shared_metrics():
+    global _shared_metrics
+    with _lock:
+        if _shared_metrics is None:
+            _shared_metrics = SharedMetrics(path=os.environ.get("SYNC_CACHE_PATH"))
+        return _shared_metrics
+
 
 @app.route('/')
 def hello():
@@ -16,17 +53,67 @@ def hello():
 @app.route('/sync')
 def run():
     """
-    Run a sync of the Scoro to ClearBooks process
+    Start a sync of the Scoro to ClearBooks process in the background and
+    return the job id to poll.
     """
-    errors = run_sync()
+    job_id, started = get_jobs().submit()
 
-    if len(errors) == 0:
-        return "Completed successfully"
+    if started:
+        return "Sync started: {}\n".format(job_id), 202
+    elif job_id:
+        return "Sync already running: {}\n".format(job_id), 409
     else:
-        messages = ""
-        for e in errors:
-            messages += "INV{}: {}\n".format(e["invoice"], e["error"])
-        return "Complete with {} errors\n{}".format(len(errors), messages)
+        return "Sync already running\n", 409
+
+
+@app.route('/sync/<job_id>')
+def sync_status(job_id):
+    """
+    Report the progress and result of a sync job.
+    """
+    job = get_jobs().status(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    messages = ""
+    for e in job["errors"]:
+        messages += "INV{}: {}\n".format(e["invoice"], e["error"])
+    job["summary"] = messages
+    return jsonify(job)
+
+
+@app.route('/webhook/scoro', methods=['POST'])
+def scoro_webhook():
+    """
+    Queue the invoice named by a Scoro invoice create or modify event. The
+    token set in SCORO_WEBHOOK_TOKEN must be given as ?token= or in the
+    X-Webhook-Token header.
+    """
+    token = os.environ.get("SCORO_WEBHOOK_TOKEN", "")
+    given = request.args.get("token") or request.headers.get("X-Webhook-Token", "")
+    if not token or not hmac.compare_digest(token.encode("utf-8"), given.encode("utf-8")):
+        return "Forbidden\n", 403
+
+    invoice_id = invoice_event(request.get_json(force=True, silent=True))
+    if invoice_id is None:
+        return "Ignored\n", 200
+    if get_webhooks().submit(invoice_id):
+        return "Queued: {}\n".format(invoice_id), 202
+    return "Already queued: {}\n".format(invoice_id), 202
+
+
+@app.route('/metrics')
+def metrics_report():
+    """
+    Expose the timings and counters of every worker and sync run, with the
+    summary of the last run, for Prometheus. The cache figures are those of
+    the worker serving the scrape.
+    """
+    shared = get_shared_metrics()
+    metrics.flush(shared)
+    return Response(
+        shared.render() + metrics.render_caches(pid=os.getpid()),
+        mimetype="text/plain; version=0.0.4")
 
 
 @app.errorhandler(500)
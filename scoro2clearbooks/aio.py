@@ -0,0 +1,577 @@
+"""
+Asyncio clients for Scoro and ClearBooks, and a sync that runs on them.
+
+The async clients wrap the threaded ones: settings, caches, the SOAP
+serializer and the mapping of Scoro records to ClearBooks records are shared,
+only the network calls differ. Each invoice moves through its own chain of
+coroutines, so thousands of calls can be in flight without a thread each.
+"""
+import json
+import asyncio
+import logging
+from urllib.parse import urlparse
+
+import aiohttp
+
+from scoro2clearbooks import soap
+from scoro2clearbooks.clearbooks import (
+    ElementParser, element_record, created, created_invoice, invoice_record,
+    customer_record, account_code_record, customers_by_id, account_codes_by_name,
+    list_invoices_request, list_customers_request, list_account_codes_request)
+from scoro2clearbooks.cache import Memo
+from scoro2clearbooks.metrics import RunReport, metrics
+from scoro2clearbooks.normalize import name_key
+from scoro2clearbooks.ratelimit import RetryPolicy, bucket_for, retry_after
+from scoro2clearbooks.records import Contact, Invoice, Project
+from scoro2clearbooks.utils import (
+    InvoiceWork, open_context, with_project, _read_config)
+
+
+logger = logging.getLogger("aio")
+
+
+class AsyncHTTPSession(object):
+    """
+    Pooled aiohttp session owned by one async client, paced and retried like
+    `HTTPSession`. The token buckets are shared with the threaded clients.
+    """
+    def __init__(self, concurrency, pool_size=None, timeout=None, rate=None,
+                 retries=None):
+        self.concurrency = concurrency
+        self.pool_size = pool_size or concurrency
+        self.timeout = timeout
+        self.rate = rate
+        self.retry = RetryPolicy(retries)
+        self.session = None
+        self._slots = None
+        self.requests = 0
+
+    @classmethod
+    def like(cls, http):
+        """
+        A session with the same settings as a threaded `HTTPSession`.
+        """
+        return cls(
+            http.concurrency, pool_size=http.pool_size,
+            timeout=http.timeout, rate=http.rate, retries=http.retry.retries)
+
+    def _session(self):
+        # aiohttp sessions belong to the running loop, so open on first use
+        if self.session is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def post(self, url, read, idempotent=True, **kwargs):
+        """
+        Post a request and return `await read(response)`, retrying throttled
+        and transient failures as `HTTPSession.post` does.
+        """
+        session = self._session()
+        bucket = bucket_for(urlparse(url).netloc, self.rate)
+        data = kwargs.get("data")
+
+        attempt = 0
+        while True:
+            if callable(data):
+                kwargs["data"] = data()
+            wait = bucket.reserve()
+            while wait is not None:
+                await asyncio.sleep(wait)
+                wait = bucket.reserve()
+
+            try:
+                async with self._slots:
+                    self.requests += 1
+                    async with session.post(url, **kwargs) as response:
+                        wait = self.retry.response_wait(
+                            bucket, url, response.status, attempt, idempotent,
+                            retry_after(response))
+                        if wait is None:
+                            return await read(response)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                safe = idempotent or isinstance(e, aiohttp.ClientConnectorError)
+                wait = self.retry.error_wait(url, e, attempt, safe)
+                if wait is None:
+                    raise
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    def stats(self):
+        return {"requests": self.requests}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncScoro(object):
+    """
+    Asyncio client for the Scoro API, wrapping a `Scoro` whose caches and
+    mapping it shares.
+    """
+    def __init__(self, scoro):
+        self.scoro = scoro
+        self.per_page = scoro.per_page
+        self.http = AsyncHTTPSession.like(scoro.http)
+        # Invoices in flight together share one catalog sweep, and one view
+        # of each product or group they have in common
+        self._catalog = Memo()
+        self._views = Memo(keep=lambda value: False)
+
+    async def fetch(self, method, action=None, record_id=None, options=None):
+        url, data = self.scoro._request(method, action, record_id, options)
+        action = action or "list"
+        received = []
+
+        async def read(response):
+            body = await response.read()
+            received.append(len(body))
+            return response.status, body
+
+        with metrics.timer("scoro_request_seconds", method=method, action=action):
+            status, body = await self.http.post(url, read, data=data)
+        metrics.inc("scoro_bytes_sent_total", len(data), method=method, action=action)
+        metrics.inc(
+            "scoro_bytes_received_total", sum(received), method=method, action=action)
+        return self.scoro.check_error(_json(status, body))
+
+    async def fetch_pages(self, method, action=None, options=None, per_page=None,
+                          key=None):
+        """
+        Stream the records of a list endpoint, requesting the next page while
+        the current one is consumed. See `Scoro.fetch_pages` for the sweeps
+        made when a key is given.
+        """
+        per_page = per_page or self.per_page
+
+        def page(number):
+            opts = dict(options or {})
+            opts.update({"page": number, "per_page": per_page})
+            return asyncio.ensure_future(self.fetch(method, action=action, options=opts))
+
+        seen = set()
+        while True:
+            new = 0
+            number = 1
+            pending = page(number)
+            try:
+                while pending:
+                    status, records = await pending
+                    pending = None
+                    if not status:
+                        raise ValueError(records)
+                    if not records:
+                        break
+                    if len(records) == per_page:
+                        number += 1
+                        pending = page(number)
+
+                    for r in records:
+                        if key:
+                            if r[key] in seen:
+                                continue
+                            seen.add(r[key])
+                        new += 1
+                        yield r
+            finally:
+                if pending:
+                    pending.cancel()
+            if not key or new == 0:
+                return
+
+    async def invoices(self, modified_since=None):
+        options = self.scoro._invoices_options(modified_since)
+        async for record in self.fetch_pages("invoices", options=options, key="id"):
+            yield record
+
+    async def view(self, method, record_id, record=None):
+        """
+        Fetch a single record, parsed with `record.from_json` if given. See
+        `Scoro.view`.
+        """
+        data = (await self.fetch(method, action="view", record_id=record_id))[1]
+        return record.from_json(data) if record and isinstance(data, dict) else data
+
+    async def invoice(self, record_id):
+        return await self.view("invoices", record_id, Invoice)
+
+    async def contact(self, record_id):
+        return await self.scoro.contacts.get_async(
+            str(record_id), lambda: self.view("contacts", record_id, Contact))
+
+    async def project(self, record_id):
+        return await self.scoro.projects.get_async(
+            str(record_id), lambda: self.view("projects", record_id, Project))
+
+    async def prefetch_products(self, product_ids):
+        """
+        Load the products and groups used by an invoice into the shared
+        caches, so that mapping it makes no calls.
+        """
+        scoro = self.scoro
+        missing = scoro._missing_products(product_ids)
+        if not missing:
+            return
+
+        if scoro._bulk(missing):
+            await self._catalog.get_async("products", lambda: self._load_catalog(missing))
+            # Products the catalog was too big to keep are viewed instead
+            missing = scoro._missing_products(product_ids)
+            if not missing:
+                return
+
+        missing = sorted(missing)
+        records = await _run_all([self._view("products", key) for key in missing])
+        records = {key: p for key, p in zip(missing, records) if isinstance(p, dict)}
+        groups = scoro._missing_groups(records.values())
+        names = await _run_all([self._view("productGroups", key) for key in groups])
+        scoro._cache_product_groups({
+            key: g["name"] for key, g in zip(groups, names) if isinstance(g, dict)})
+        scoro._cache_products(records)
+
+    async def _load_catalog(self, missing):
+        self.scoro._cache_catalog(
+            [g async for g in self.fetch_pages("productGroups", action="list")],
+            [p async for p in self.fetch_pages("products", action="list")],
+            missing)
+        return True
+
+    def _view(self, method, record_id):
+        return self._views.get_async(
+            (method, record_id), lambda: self.view(method, record_id))
+
+    async def update_invoice(self, invoice, cb_inv_no):
+        return self.scoro.updated(invoice, await self.fetch(
+            "invoices", action="modify", record_id=invoice.id,
+            options=self.scoro._invoice_update(cb_inv_no)))
+
+    async def close(self):
+        await self.http.close()
+
+
+class AsyncClearBooks(object):
+    """
+    Asyncio client for the ClearBooks API, wrapping a `ClearBooks` whose
+    settings it shares.
+    """
+    def __init__(self, clearbooks):
+        self.clearbooks = clearbooks
+        self.http = AsyncHTTPSession.like(clearbooks.http)
+
+    async def _records(self, operations, action, tag, stream=False):
+        """
+        Post a request and return the attributes of each `tag` element in the
+        response, parsed as it is read.
+        """
+        cb = self.clearbooks
+        request = cb._request(operations, action, stream)
+        if stream:
+            # aiohttp sends an async generator as a chunked body
+            chunks = request["data"]
+
+            async def payload():
+                for chunk in chunks():
+                    yield chunk
+            request["data"] = payload
+
+        async def read(response):
+            parser = ElementParser((tag, "faultstring"))
+            records = []
+            async for chunk in response.content.iter_chunked(cb.CHUNK_SIZE):
+                metrics.inc("clearbooks_bytes_received_total", len(chunk), action=action)
+                for name, el in parser.feed(chunk):
+                    if name == "faultstring":
+                        raise ValueError(el.text)
+                    records.append(element_record(el))
+            parser.close()
+            return records
+
+        with metrics.timer("clearbooks_request_seconds", action=action):
+            return await self.http.post(cb.url, read, **request)
+
+    async def _create_many(self, items, build, action, tag):
+        """
+        See `ClearBooks._create_many`; the envelopes are sent concurrently.
+        """
+        async def send(group, stream):
+            try:
+                return created(group, tag, await self._records(
+                    lambda: [build(item) for item in group], action, tag,
+                    stream=stream))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return [(None, e)] * len(group)
+
+        results = await asyncio.gather(*[
+            send(group, stream) for group, stream in self.clearbooks._groups(items)])
+        return [result for group in results for result in group]
+
+    async def create_customer(self, customer):
+        el, error = (await self.create_customers([customer]))[0]
+        if error:
+            raise error
+        return el
+
+    async def create_customers(self, customers):
+        results = await self._create_many(
+            customers, soap.customer, "createEntity", "createEntityReturn")
+        return [(el["_text"] if el else None, error) for el, error in results]
+
+    async def create_invoice(self, invoice):
+        inv, error = (await self.create_invoices([invoice]))[0]
+        if error:
+            raise error
+        return inv
+
+    async def create_invoices(self, invoices):
+        results = await self._create_many(
+            invoices, soap.invoice, "createInvoice", "createInvoiceReturn")
+        return [(created_invoice(el) if el else None, error) for el, error in results]
+
+    async def list_invoices(self):
+        records = await self._records(list_invoices_request, "listInvoices", "Invoice")
+        return [invoice_record(el) for el in records]
+
+    async def list_customers(self):
+        records = await self._records(list_customers_request, "listEntities", "Entity")
+        return customers_by_id(customer_record(el) for el in records)
+
+    async def list_account_codes(self):
+        records = await self._records(
+            list_account_codes_request, "listAccountCodes", "AccountCode")
+        return account_codes_by_name(account_code_record(el) for el in records)
+
+    async def close(self):
+        await self.http.close()
+
+
+def _json(status, body):
+    try:
+        return json.loads(body.decode("utf-8"))
+    except ValueError:
+        raise ValueError("Invalid response from Scoro (HTTP {})".format(status))
+
+
+class AsyncSync(object):
+    """
+    One async run: the shared context of `run_sync` plus the async clients
+    and the per-customer locks of the event loop.
+    """
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.scoro = AsyncScoro(ctx.scoro)
+        self.clearbooks = AsyncClearBooks(ctx.clearbooks)
+        self.customer_locks = {}
+
+    async def process(self, w):
+        """
+        Transfer one invoice. Returns its error record or None; only
+        cancellation escapes.
+        """
+        try:
+            await self._process(w)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            w.fail(e)
+        return w.error
+
+    async def _process(self, w):
+        ctx = self.ctx
+        scoro = self.scoro
+        loop = asyncio.get_event_loop()
+
+        with metrics.timer("sync_stage_seconds", stage="invoice"):
+            w.invoice = await scoro.invoice(w.inv["id"])
+        if not isinstance(w.invoice, Invoice):
+            raise ValueError(w.invoice or "Invoice not found")
+        w.inv.update(no=w.invoice.no, date=w.invoice.date)
+        if not ctx.scoro.needs_transfer(w.invoice):
+            logger.info("Invoice {} is already transferred".format(w.inv["no"]))
+            metrics.inc("sync_invoices_total", status="skipped")
+            return
+
+        # The contact, project and products are independent reads
+        invoice = w.invoice
+        project_id = invoice.project_id
+        with metrics.timer("sync_stage_seconds", stage="reads"):
+            w.customer, project, _ = await _run_all([
+                scoro.contact(invoice.company_id),
+                scoro.project(project_id) if project_id != "0" else _none(),
+                scoro.prefetch_products(
+                    l.product_id for l in invoice.lines)])
+        w.customer_name = ctx.scoro.customer_name(w.customer)
+        w.customer_id = await self._customer(w)
+
+        ledger = await self._loaded("ledger")
+        existing = ledger.get(invoice.no, w.customer_id) if ledger else None
+        if existing:
+            logger.info("Invoice {} is already in ClearBooks".format(w.inv["no"]))
+            w.cb_number = existing["invoice_number"]
+            w.repaired = True
+        else:
+            with_project(invoice, project)
+
+            # Any lookup the prefetch missed is a blocking call, so map on a thread
+            accounts = await self._loaded("account_codes")
+            await self._loaded("finance_objects")
+            with metrics.timer("sync_stage_seconds", stage="map_invoice"):
+                w.cb_invoice = await loop.run_in_executor(
+                    None, ctx.scoro.clearbooks_invoice, w.customer_id, invoice, accounts)
+            with metrics.timer("sync_stage_seconds", stage="create_invoices"):
+                cb_inv = await self.clearbooks.create_invoice(w.cb_invoice)
+            w.cb_number = cb_inv["invoice_number"]
+            if ledger is not None:
+                ledger.add(dict(cb_inv, entity_id=w.customer_id))
+
+        with metrics.timer("sync_stage_seconds", stage="update_invoice"):
+            await scoro.update_invoice(w.invoice, w.cb_number)
+        ctx.checkpoint.done(w.inv["id"], w.inv.get("date"))
+        metrics.inc("sync_invoices_total", status="repaired" if w.repaired else "ok")
+        ctx.invoice_done()
+
+    async def _loaded(self, name):
+        """
+        The reference data of a name, awaited without blocking the loop. See
+        `SyncContext.wait`.
+        """
+        future = self.ctx.loads.get(name)
+        return await asyncio.wrap_future(future) if future else None
+
+    async def _customer(self, w):
+        """
+        Find or create the ClearBooks customer of an invoice. Creation is
+        serialized per normalized name, as in the threaded sync.
+        """
+        ctx = self.ctx
+        loop = asyncio.get_event_loop()
+        customers = await self._loaded("customers")
+        lock = self.customer_locks.setdefault(name_key(w.customer_name), asyncio.Lock())
+        async with lock:
+            # A miss may reload the customer list, which blocks
+            cust_id = await loop.run_in_executor(
+                None, customers.get, w.customer_name, w.customer.contact_id)
+            if cust_id:
+                return cust_id
+            customer = ctx.scoro.clearbooks_customer(w.customer)
+            logger.info("Create ClearBooks customer {}".format(customer.company_name))
+            with metrics.timer("sync_stage_seconds", stage="create_customers"):
+                cust_id = await self.clearbooks.create_customer(customer)
+            customers.add(cust_id, customer)
+            return cust_id
+
+    async def close(self):
+        await self.scoro.close()
+        await self.clearbooks.close()
+
+
+async def _none():
+    return None
+
+
+async def _run_all(coros):
+    """
+    Run coroutines concurrently and return their results in order. If one
+    fails or the run is cancelled, the others are cancelled and awaited
+    before the error is raised.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run_sync_async(workers=None, refresh=None, full_scan=None, progress=None,
+                         config=None):
+    """
+    Transfer the unpaid Scoro invoices to ClearBooks on the event loop and
+    return the errors.
+
+    `workers` is the number of invoices in flight at once. The reference
+    data loads in the background as in `run_sync`, and each invoice awaits
+    only the parts it needs.
+    """
+    if config is None:
+        config = _read_config()
+    workers = workers or config["sync"]["workers"]
+    full_scan = full_scan or (full_scan is None and config["sync"]["full_scan"])
+    loop = asyncio.get_event_loop()
+    report = RunReport(config["sync"]["cache_path"])
+    ctx = await loop.run_in_executor(None, lambda: open_context(config, refresh=refresh))
+    run = AsyncSync(ctx)
+    checkpoint = ctx.checkpoint
+    logger.info("Process invoices with {} in flight".format(workers))
+    slots = asyncio.Semaphore(workers)
+    tasks = []
+    in_flight = set()
+    counts = {"done": 0, "errors": 0}
+    errors = None
+
+    async def process(w):
+        try:
+            return await run.process(w)
+        finally:
+            slots.release()
+
+    def finished(task):
+        in_flight.discard(task)
+        if task.cancelled():
+            return
+        counts["done"] += 1
+        if task.result():
+            counts["errors"] += 1
+        if progress:
+            progress(done=counts["done"], total=len(tasks), errors=counts["errors"])
+
+    try:
+        if full_scan:
+            checkpoint.reset()
+        checkpoint.begin()
+        # Invoices are taken from the listing as slots free up, and the
+        # results are collected in listing order
+        async for inv in run.scoro.invoices(modified_since=checkpoint.modified_since):
+            if checkpoint.is_done(inv["id"]):
+                continue
+            ctx.check()
+            await slots.acquire()
+            task = asyncio.ensure_future(process(InvoiceWork(inv)))
+            in_flight.add(task)
+            task.add_done_callback(finished)
+            tasks.append(task)
+        errors = [e for e in await asyncio.gather(*tasks) if e]
+        checkpoint.finish(clean=len(errors) == 0)
+    except BaseException:
+        # Cancel whatever is still in flight, and let it unwind before the
+        # clients are closed
+        for task in list(in_flight):
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        raise
+    finally:
+        logger.info("Scoro requests: {}".format(run.scoro.http.stats()))
+        logger.info("ClearBooks requests: {}".format(run.clearbooks.http.stats()))
+        await run.close()
+        ctx.close()
+        report.finish(errors, ctx.first_invoice)
+    return errors
+
+
+def run_sync(**kwargs):
+    """
+    Run `run_sync_async` on a new event loop.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run_sync_async(**kwargs))
+    finally:
+        loop.close()
@@ -0,0 +1,178 @@
+import time
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-limited cache that evicts the least recently used
+    entry, with an optional time-to-live and hit/miss counters.
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, records):
+        for key, value in records.items():
+            self.set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        # A peek that does not count as a lookup or refresh the entry
+        with self._lock:
+            entry = self._data.get(key)
+        return entry is not None and not (
+            self.ttl and time.time() - entry[1] > self.ttl)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class Memo(object):
+    """
+    Thread-safe memo of lookups for the length of one run. A lookup of a key
+    that is already being fetched waits for that fetch instead of making its
+    own. Failed fetches, and values rejected by `keep`, are not remembered.
+    """
+    def __init__(self, keep=None):
+        self.keep = keep
+        self._values = {}
+        self._pending = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, fetch):
+        """
+        The value of `key`, calling `fetch()` if nobody has yet.
+        """
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+            waiting = self._pending.get(key)
+            if waiting is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                future = self._pending[key] = Future()
+        if waiting is not None:
+            return waiting.result()
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        self._settle(key, value, self._pending)
+        future.set_result(value)
+        return value
+
+    async def get_async(self, key, fetch):
+        """
+        The value of `key`, awaiting `fetch()` if nobody has yet. The shared
+        fetch is only cancelled once every coroutine waiting on it is.
+        """
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+            entry = self._tasks.get(key)
+            if entry is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                task = asyncio.ensure_future(fetch())
+                task.add_done_callback(functools.partial(self._finished, key))
+                entry = self._tasks[key] = [task, 0]
+            entry[1] += 1
+        task = entry[0]
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _finished(self, key, task):
+        if task.cancelled() or task.exception() is not None:
+            with self._lock:
+                self._tasks.pop(key, None)
+        else:
+            self._settle(key, task.result(), self._tasks)
+
+    def _settle(self, key, value, pending):
+        with self._lock:
+            if self.keep is None or self.keep(value):
+                self._values[key] = value
+            del pending[key]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def stats(self):
+        # A coalesced lookup made no call of its own, so counts as a hit
+        hits = self.hits + self.coalesced
+        lookups = hits + self.misses
+        return {
+            "size": len(self._values),
+            "hits": hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
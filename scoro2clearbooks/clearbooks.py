@@ -1,12 +1,140 @@
-import requests
+import time
 import logging
-from xml.dom.minidom import parse
-from xml.dom.minidom import parseString
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import XMLPullParser
+from scoro2clearbooks import soap
+from scoro2clearbooks.metrics import metrics
+from scoro2clearbooks.normalize import name_key
+from scoro2clearbooks.session import HTTPSession
 
 
 logger = logging.getLogger("clearbooks")
 
 
+class ElementParser(object):
+    """
+    Incrementally parse an XML document fed in byte chunks.
+
+    Each feed returns `(name, element)` for the elements whose local name is
+    in `tags` and whose end tag has now been read. Elements are dropped from
+    the tree once they are complete, so memory stays flat however long the
+    document.
+    """
+    def __init__(self, tags):
+        self.tags = tags
+        self.parser = XMLPullParser(events=("start", "end"))
+        self.stack = []
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+        found = []
+        for event, el in self.parser.read_events():
+            if event == "start":
+                self.stack.append(el)
+                continue
+
+            self.stack.pop()
+            name = el.tag.rsplit("}", 1)[-1]
+            if name in self.tags:
+                found.append((name, el))
+            if self.stack:
+                self.stack[-1].remove(el)
+        return found
+
+    def close(self):
+        self.parser.close()
+
+
+def iter_elements(chunks, tags):
+    """
+    Incrementally parse an XML document from a stream of byte chunks,
+    yielding `(name, element)` for each element whose local name is in
+    `tags` as soon as its end tag has been read.
+    """
+    parser = ElementParser(tags)
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+    parser.close()
+
+
+def element_record(el):
+    attrs = dict(el.attrib)
+    attrs["_text"] = el.text
+    return attrs
+
+
+def list_invoices_request():
+    return [soap.query("listInvoices", [("ledger", "sales")])]
+
+
+def list_customers_request():
+    return [soap.query("listEntities", [("type", "customer")])]
+
+
+def list_account_codes_request():
+    return [soap.operation("listAccountCodes")]
+
+
+def invoice_record(el):
+    return {
+        "entity_id": el.get("entityId", ""),
+        "invoice_id": el.get("invoice_id", ""),
+        "invoice_prefix": el.get("invoice_prefix", ""),
+        "invoice_number": el.get("invoiceNumber", ""),
+        "date_created": el.get("dateCreated", ""),
+        "reference": el.get("reference", ""),
+        "status": el.get("status", ""),
+        "gross": el.get("gross", ""),
+        "net": el.get("net", ""),
+        "vat": el.get("vat", ""),
+    }
+
+
+def customer_record(el):
+    return {
+        "id": el.get("id", ""),
+        "company_name": el.get("company_name", ""),
+        "external_id": el.get("external_id", ""),
+    }
+
+
+def account_code_record(el):
+    return {
+        "id": el.get("id", ""),
+        "account_name": el.get("account_name", "").replace("&amp;", "&"),
+    }
+
+
+def customers_by_id(customers):
+    return {
+        c["id"]: {"company_name": c["company_name"], "external_id": c["external_id"]}
+        for c in customers}
+
+
+def account_codes_by_name(codes):
+    return {a["account_name"]: a["id"] for a in codes}
+
+
+def created(group, tag, records):
+    """
+    Pair the records of a create response with the items of its envelope.
+    """
+    if len(records) != len(group):
+        raise ValueError("Expected {} {} in the ClearBooks response, got {}".format(
+            len(group), tag, len(records)))
+    return [(record, None) for record in records]
+
+
+def created_invoice(el):
+    return {
+        "invoice_id": el.get("invoice_id", ""),
+        "invoice_prefix": el.get("invoice_prefix", ""),
+        "invoice_number": el.get("invoice_number", ""),
+    }
+
+
 class ClearBooks(object):
     """
     Interact with the ClearBooks API.
@@ -16,206 +144,282 @@ class ClearBooks(object):
     HEADERS = {
         "Content-Type": "text/xml",
     }
-
-    REQUEST = """<?xml version="1.0" encoding="UTF-8"?>
-        <SOAP-ENV:Envelope 
-            xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"
-            xmlns:ns1="https://secure.clearbooks.co.uk/api/accounting/soap/" 
-            xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-        <SOAP-ENV:Header>
-            <ns1:authenticate>
-            <apiKey>{api_key}</apiKey>
-            </ns1:authenticate>
-        </SOAP-ENV:Header>
-        <SOAP-ENV:Body>
-            {body}
-        </SOAP-ENV:Body>
-        </SOAP-ENV:Envelope>
-    """
-
-    def __init__(self, api_key):
+    CONCURRENCY = 2
+    RATE = 10
+    # Create operations per SOAP envelope. The ClearBooks endpoint answers one
+    # operation per request, so by default writes are only pipelined
+    BATCH_SIZE = 1
+    CHUNK_SIZE = 64 * 1024
+    # Envelopes with more invoice lines than this are streamed to the socket
+    STREAM_LINES = 1000
+
+    def __init__(self, api_key, concurrency=None, pool_size=None, timeout=None,
+                 url=None, rate=None, retries=None, batch_size=None):
         self.api_key = api_key
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.url = url or self.URL
+        self.http = HTTPSession(
+            concurrency or self.CONCURRENCY, pool_size=pool_size, timeout=timeout,
+            rate=rate or self.RATE, retries=retries)
 
-    def _post(self, body, action):
-        payload = self.REQUEST.format(**{"api_key": self.api_key, "body": body})
+    def _request(self, operations, action, stream=False):
+        """
+        The arguments of the post sending the operations returned by
+        `operations()` in one envelope.
+
+        A streamed envelope is a callable producing the body in chunks, so it
+        is serialized straight onto the connection and rebuilt from
+        `operations()` if the request has to be retried.
+        """
         headers = self.HEADERS.copy()
         headers["SOAPAction"] = self.URI + "#" + action
 
-        response = requests.post(self.URL, data=payload, headers=headers)
+        if stream:
+            def payload():
+                for chunk in soap.iter_envelope(self.api_key, operations()):
+                    metrics.inc("clearbooks_bytes_sent_total", len(chunk), action=action)
+                    yield chunk
+            data = payload
+        else:
+            data = soap.envelope(self.api_key, operations()).encode("utf-8")
+            metrics.inc("clearbooks_bytes_sent_total", len(data), action=action)
+
+        # Only list calls are safe to resend after a server error
+        return {"data": data, "headers": headers, "idempotent": action.startswith("list")}
+
+    def _post(self, operations, action, stream=False):
+        return self.http.post(
+            self.url, stream=True, **self._request(operations, action, stream))
 
-        dom = parseString(response.text)
-        return dom
+    def _records(self, operations, action, tag, stream=False):
+        """
+        Post a request and yield the attributes of each `tag` element in the
+        response while it is still being read.
+        """
+        start = time.time()
+        response = self._post(operations, action, stream=stream)
+        # Bytes read and seconds spent waiting on the network
+        received = [0, 0.0]
+
+        def chunks():
+            content = response.iter_content(chunk_size=self.CHUNK_SIZE)
+            while True:
+                t = time.time()
+                chunk = next(content, None)
+                received[1] += time.time() - t
+                if chunk is None:
+                    return
+                received[0] += len(chunk)
+                yield chunk
+
+        parsing = 0.0
+        try:
+            elements = iter_elements(chunks(), (tag, "faultstring"))
+            while True:
+                t = time.time()
+                waited = received[1]
+                item = next(elements, None)
+                parsing += time.time() - t - (received[1] - waited)
+                if item is None:
+                    break
+
+                name, el = item
+                if name == "faultstring":
+                    raise ValueError(el.text)
+                yield element_record(el)
+        finally:
+            response.close()
+            metrics.observe("clearbooks_request_seconds", time.time() - start, action=action)
+            metrics.observe("clearbooks_parse_seconds", parsing, action=action)
+            metrics.inc("clearbooks_bytes_received_total", received[0], action=action)
+
+    def _create_many(self, items, build, action, tag):
+        """
+        Send a list of create operations and return a `(record, error)` pair
+        per item, in order.
+
+        Up to `batch_size` operations share an envelope, and the envelopes
+        are pipelined over the pooled connections. If an envelope fails, every
+        item in it gets the error.
+        """
+        groups = self._groups(items)
+
+        def send(group_stream):
+            group, stream = group_stream
+            try:
+                return created(group, tag, list(self._records(
+                    lambda: [build(item) for item in group], action, tag,
+                    stream=stream)))
+            except Exception as e:
+                return [(None, e)] * len(group)
+
+        if len(groups) == 1:
+            return send(groups[0])
+        with ThreadPoolExecutor(max_workers=self.http.concurrency) as pool:
+            return [result for results in pool.map(send, groups) for result in results]
+
+    def _groups(self, items):
+        """
+        Split items into envelopes of up to `batch_size`, returning each
+        with whether it has enough invoice lines to be streamed.
+        """
+        size = self.batch_size
+        groups = []
+        for i in range(0, len(items), size):
+            group = items[i:i + size]
+            lines = sum(len(getattr(item, "items", ())) for item in group)
+            groups.append((group, lines > self.STREAM_LINES))
+        return groups
 
     def create_customer(self, customer):
         """
         Create customer.
         """
-        body = """
-            <ns1:createEntity>
-            <entity
-                company_name="{company_name}"
-                building="{building}"
-                address1="{address1}"
-                address2="{address2}"
-                town="{town}"
-                county="{county}"
-                country="{country}"
-                postcode="{postcode}"
-                email="{email}"
-                phone1="{phone1}"
-                phone2="{phone2}"
-                fax="{fax}"
-                website="{website}"
-                external_id="{external_id}">
-                <customer default_account_code="0" default_vat_rate="0.00" default_credit_terms="30" />
-            </entity>
-            </ns1:createEntity>
-        """.format(**customer)
-
-        payload = self.REQUEST.format(**{"api_key": self.api_key, "body": body})
-        headers = self.HEADERS.copy()
-        headers["SOAPAction"] = self.URI + "#createEntity"
-
-        response = requests.post(self.URL, data=payload, headers=self.HEADERS)
-
-        dom = parseString(response.text)
-        # print( dom.toprettyxml() )
-        el = dom.getElementsByTagName("createEntityReturn")[0]
-        return el.firstChild.nodeValue
-
-    def _invoice_items(self, items):
-        body = """
-        <ns1:Item
-            vatRate="{vatRate}"
-            project="0"
-            type="{type}"
-            quantity="{quantity}"
-            unitPrice="{unitPrice}">
-                <description>{description}</description>
-        </ns1:Item>
-        """
-        xml = ""
-        for i in items:
-            xml += body.format(**i)
-        return xml
+        el, error = self.create_customers([customer])[0]
+        if error:
+            raise error
+        return el["_text"]
+
+    def create_customers(self, customers):
+        """
+        Create several customers, returning `(entity_id, error)` for each.
+        """
+        results = self._create_many(
+            customers, soap.customer, "createEntity", "createEntityReturn")
+        return [(el["_text"] if el else None, error) for el, error in results]
 
     def create_invoice(self, invoice):
         """
         Create invoice.
         """
-        invoice["item_body"] = self._invoice_items(invoice["items"])
-        body = """
-            <ns1:createInvoice>
-            <invoice
-                invoice_prefix="INV"
-                invoice_number="{invoice_number}"
-                entityId="{entityId}"
-                dateDue="{dateDue}"
-                dateCreated="{dateCreated}"
-                type="sales"
-                creditTerms="30"
-                project="0"
-                status="approved">
-                <items>
-                    {item_body}
-                </items>
-                <description>{description}</description>
-                <reference>{reference}</reference>
-                <type>sales</type>
-            </invoice>
-            </ns1:createInvoice>
-        """.format(**invoice)
-
-        payload = self.REQUEST.format(**{"api_key": self.api_key, "body": body})
-        # print(payload)
-        headers = self.HEADERS.copy()
-        headers["SOAPAction"] = self.URI + "#createInvoice"
-
-        response = requests.post(self.URL, data=payload, headers=self.HEADERS)
+        inv, error = self.create_invoices([invoice])[0]
+        if error:
+            raise error
+        return inv
 
-        dom = parseString(response.text)
-        # print( dom.toprettyxml() )
-        el = dom.getElementsByTagName("createInvoiceReturn")[0]
+    def create_invoices(self, invoices):
+        """
+        Create several invoices, returning `(invoice, error)` for each.
+        """
+        results = self._create_many(
+            invoices, soap.invoice, "createInvoice", "createInvoiceReturn")
+        return [
+            (created_invoice(el) if el else None, error)
+            for el, error in results]
 
-        inv = {
-            "invoice_id": el.getAttribute("invoice_id"),
-            "invoice_prefix": el.getAttribute("invoice_prefix"),
-            "invoice_number": el.getAttribute("invoice_number"),
-        }
-        return inv
+    def iter_invoices(self):
+        """
+        Stream the sales invoices as they are read from the response.
+        """
+        for el in self._records(list_invoices_request, "listInvoices", "Invoice"):
+            yield invoice_record(el)
 
     def list_invoices(self, fromDate):
-        body = """
-            <ns1:listInvoices>
-            <query ledger="sales">
-            </query>
-            </ns1:listInvoices>
-        """
+        return list(self.iter_invoices())
 
-        payload = self.REQUEST.format(**{"api_key": self.api_key, "body": body})
-        headers = self.HEADERS.copy()
-        headers["SOAPAction"] = self.URI + "#listInvoices"
-
-        response = requests.post(self.URL, data=payload, headers=headers)
-
-        dom = parseString(response.text)
-        elements = dom.getElementsByTagName("ns1:Invoice")
-
-        invoices = []
-        for el in elements:
-            invoices.append({
-                "entity_id": el.getAttribute("entityId"),
-                "invoice_id": el.getAttribute("invoice_id"),
-                "invoice_prefix": el.getAttribute("invoice_prefix"),
-                "invoice_number": el.getAttribute("invoiceNumber"),
-                "date_created": el.getAttribute("dateCreated"),
-                "reference": el.getAttribute("reference"),
-                "status": el.getAttribute("status"),
-                "gross": el.getAttribute("gross"),
-                "net": el.getAttribute("net"),
-                "vat": el.getAttribute("vat"),
-            })
-
-        return invoices
+    def iter_customers(self):
+        """
+        Stream the customers as they are read from the response.
+        """
+        for el in self._records(list_customers_request, "listEntities", "Entity"):
+            yield customer_record(el)
 
     def list_customers(self):
         """
-        Fetch all the customers.
+        Fetch all the customers, keyed on id.
+        """
+        return customers_by_id(self.iter_customers())
+
+    def iter_account_codes(self):
         """
-        body = """
-            <ns1:listEntities>
-            <query type="customer">
-            </query>
-            </ns1:listEntities>
+        Stream the account codes as they are read from the response.
         """
+        for el in self._records(list_account_codes_request, "listAccountCodes", "AccountCode"):
+            yield account_code_record(el)
 
-        payload = self.REQUEST.format(**{"api_key": self.api_key, "body": body})
-        headers = self.HEADERS.copy()
-        headers["SOAPAction"] = self.URI + "#listEntities"
+    def list_account_codes(self):
+        """
+        Fetch all the account codes.
+        """
+        return account_codes_by_name(self.iter_account_codes())
 
-        response = requests.post(self.URL, data=payload, headers=headers)
 
-        dom = parseString(response.text)
-        records = dom.getElementsByTagName("ns1:Entity")
+class InvoiceIndex(object):
+    """
+    In-memory index of the sales invoices already in ClearBooks, keyed on the
+    invoice prefix and number, so a sync can tell whether an invoice was
+    already created.
+    """
+    # The prefix `soap.invoice` creates invoices with
+    PREFIX = "INV"
+
+    def __init__(self, invoices=()):
+        self._lock = threading.Lock()
+        self.by_number = {}
+        for inv in invoices:
+            self.add(inv)
+
+    @staticmethod
+    def _key(number, prefix):
+        number = str(number or "")
+        prefix = str(prefix or "")
+        # Some documents give the number with its prefix
+        if prefix and number.startswith(prefix):
+            number = number[len(prefix):]
+        return (prefix, number)
+
+    def add(self, invoice):
+        key = self._key(invoice.get("invoice_number"), invoice.get("invoice_prefix"))
+        if key[1]:
+            with self._lock:
+                self.by_number[key] = invoice
+
+    def get(self, number, entity_id):
+        """
+        The invoice created by the sync with this number for this customer,
+        if any. Credit notes, other prefixes and other customers' invoices
+        with the same number are not matches.
+        """
+        invoice = self.by_number.get(self._key(number, self.PREFIX))
+        if invoice and str(invoice.get("entity_id")) == str(entity_id):
+            return invoice
+        return None
 
-        customers = {}
-        for el in records:
-            customers[el.getAttribute("company_name")] = el.getAttribute("id")
-        return customers
+    def __len__(self):
+        return len(self.by_number)
 
-    def list_account_codes(self):
-        """
-        Fetch all the account codes.
+
+class CustomerIndex(object):
+    """
+    ClearBooks customer ids by external id, the Scoro contact id a customer
+    was created from, and by normalized company name.
+    """
+    def __init__(self, customers=()):
+        self._by_external = {}
+        self._by_name = {}
+        for c in customers:
+            self.add(c)
+
+    def add(self, customer):
         """
-        body = """
-            <ns1:listAccountCodes>
-            </ns1:listAccountCodes>
+        Index a customer with `id`, `company_name` and `external_id`.
         """
-        dom = self._post(body, "listAccountCodes")
-        records = dom.getElementsByTagName("ns1:AccountCode")
+        if customer.get("external_id"):
+            self._by_external[str(customer["external_id"])] = customer["id"]
+        key = name_key(customer.get("company_name"))
+        if key:
+            self._by_name[key] = customer["id"]
 
-        accounts = {}
-        for el in records:
-            account_name = el.getAttribute("account_name").replace("&amp;", "&")
-            accounts[account_name] = el.getAttribute("id")
-        return accounts
+    def get(self, name, external_id=None):
+        """
+        Find a customer by external id, falling back to the name for customers
+        created by hand or before external ids were set.
+        """
+        if external_id:
+            cust_id = self._by_external.get(str(external_id))
+            if cust_id:
+                return cust_id
+        return self._by_name.get(name_key(name))
+
+    def __len__(self):
+        return len(set(self._by_external.values()) | set(self._by_name.values()))
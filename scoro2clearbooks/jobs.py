@@ -0,0 +1,137 @@
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+from scoro2clearbooks.store import connect, default_path
+
+
+logger = logging.getLogger("jobs")
+
+
+class SyncLock(object):
+    """
+    Cross-process lock that is held while a sync runs, so that the cron job
+    and the web workers never run two syncs at once.
+    """
+    def __init__(self, path=None):
+        self.path = (path or default_path()) + ".lock"
+        self._file = None
+
+    def acquire(self):
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class JobQueue(object):
+    """
+    Run syncs in a background thread and keep their progress in SQLite, so
+    any web worker can report on a job that another worker started.
+    """
+    def __init__(self, target, path=None):
+        self.target = target
+        self.path = path or default_path()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self.db = connect(self.path)
+        with self._db_lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT, created REAL, started REAL, "
+                "finished REAL, done INTEGER, total INTEGER, errors TEXT, message TEXT)")
+
+    def submit(self, **kwargs):
+        """
+        Start a sync unless one is already running.
+
+        Returns the job id and whether it is a new job. The id is None when the
+        running sync was not started through the queue, e.g. from cron.
+        """
+        with self._lock:
+            lock = SyncLock(self.path)
+            if not lock.acquire():
+                job = self.latest()
+                active = job and job["status"] in ("queued", "running")
+                return (job["id"] if active else None), False
+
+            job_id = uuid.uuid4().hex
+            with self._db_lock, self.db:
+                self.db.execute(
+                    "INSERT INTO jobs VALUES (?, 'queued', ?, NULL, NULL, 0, 0, '[]', '')",
+                    (job_id, time.time()))
+            thread = threading.Thread(
+                target=self._run, args=(job_id, lock), kwargs=kwargs)
+            thread.daemon = True
+            thread.start()
+            return job_id, True
+
+    def _run(self, job_id, lock, **kwargs):
+        self._update(job_id, status="running", started=time.time())
+        try:
+            errors = self.target(
+                progress=lambda **p: self._update(job_id, **p), **kwargs)
+            self._update(
+                job_id, status="complete", finished=time.time(),
+                errors=json.dumps(errors))
+        except Exception as e:
+            logger.exception("Sync job {} failed".format(job_id))
+            self._update(job_id, status="failed", finished=time.time(), message=str(e))
+        finally:
+            lock.release()
+
+    def _update(self, job_id, **fields):
+        # Progress reports the error count; the list is stored at the end
+        if isinstance(fields.get("errors"), int):
+            del fields["errors"]
+        columns = ", ".join("{}=?".format(k) for k in fields)
+        with self._db_lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET {} WHERE id=?".format(columns),
+                list(fields.values()) + [job_id])
+
+    def status(self, job_id):
+        """
+        Report the progress of a job, or None if it is unknown.
+        """
+        with self._db_lock:
+            row = self.db.execute(
+                "SELECT id, status, created, started, finished, done, total, "
+                "errors, message FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if not row:
+            return None
+
+        job = dict(zip(
+            ("id", "status", "created", "started", "finished", "done", "total",
+             "errors", "message"), row))
+        job["errors"] = json.loads(job["errors"] or "[]")
+
+        # A worker that was recycled mid-run leaves its job marked as running
+        if job["status"] in ("queued", "running"):
+            lock = SyncLock(self.path)
+            if lock.acquire():
+                lock.release()
+                job["status"] = "interrupted"
+                self._update(job_id, status="interrupted")
+
+        if job["started"]:
+            job["elapsed"] = round((job["finished"] or time.time()) - job["started"], 1)
+        return job
+
+    def latest(self):
+        with self._db_lock:
+            row = self.db.execute(
+                "SELECT id FROM jobs ORDER BY created DESC LIMIT 1").fetchone()
+        return self.status(row[0]) if row else None
@@ -0,0 +1,314 @@
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from scoro2clearbooks.store import connect, default_path
+
+
+logger = logging.getLogger("metrics")
+
+
+class Metrics(object):
+    """
+    In-process registry of latency histograms, counters and cache figures,
+    rendered in the Prometheus text format or as a plain summary. `flush`
+    adds them to the `SharedMetrics` that every process reports through.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.caches = {}
+        self._flushed = ({}, {})
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = {
+                    "buckets": [0] * len(self.BUCKETS), "count": 0, "sum": 0.0,
+                    "max": 0.0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    h["buckets"][i] += 1
+            h["count"] += 1
+            h["sum"] += seconds
+            h["max"] = max(h["max"], seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def track_cache(self, name, cache):
+        """
+        Report the hit rate of a cache; the latest cache of a name wins.
+        """
+        self.caches[name] = cache
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.caches.clear()
+            self._flushed = ({}, {})
+
+    def flush(self, shared):
+        """
+        Add what has been recorded since the last flush to `shared`, and
+        return it as a registry of its own.
+        """
+        delta = Metrics()
+        with self._lock:
+            histograms, counters = self._flushed
+            for key, h in self.histograms.items():
+                last = histograms.get(key)
+                if last is None:
+                    delta.histograms[key] = dict(h, buckets=list(h["buckets"]))
+                elif h["count"] > last["count"]:
+                    delta.histograms[key] = {
+                        "buckets": [a - b for a, b in zip(h["buckets"], last["buckets"])],
+                        "count": h["count"] - last["count"],
+                        "sum": h["sum"] - last["sum"],
+                        "max": h["max"] if h["max"] > last["max"] else 0.0}
+            for key, value in self.counters.items():
+                if value != counters.get(key, 0):
+                    delta.counters[key] = value - counters.get(key, 0)
+            self._flushed = (
+                {key: dict(h, buckets=list(h["buckets"]))
+                 for key, h in self.histograms.items()},
+                dict(self.counters))
+        shared.add(delta)
+        return delta
+
+    def quantile(self, h, q):
+        """
+        Estimate a quantile from the histogram buckets.
+        """
+        target = q * h["count"]
+        for bound, count in zip(self.BUCKETS, h["buckets"]):
+            if count >= target:
+                return min(bound, h["max"])
+        return h["max"]
+
+    def render(self):
+        """
+        Format the metrics for a Prometheus scrape.
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                for bound, count in zip(self.BUCKETS, h["buckets"]):
+                    lines.append("{}_bucket{} {}".format(
+                        name, _labels(labels, le=bound), count))
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(labels, le="+Inf"), h["count"]))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), h["sum"]))
+                lines.append("{}_count{} {}".format(name, _labels(labels), h["count"]))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+        return "\n".join(lines) + "\n" + self.render_caches()
+
+    def render_caches(self, **labels):
+        """
+        Format the cache figures for a Prometheus scrape. They describe the
+        caches of this process, so are not shared.
+        """
+        lines = []
+        for name, cache in sorted(self.caches.items()):
+            stats = cache.stats()
+            for field in ("hits", "misses", "size"):
+                lines.append("cache_{}{} {}".format(
+                    field, _labels((("cache", name),), **labels), stats[field]))
+        return "".join(line + "\n" for line in lines)
+
+    def summary(self):
+        """
+        Describe the metrics in a few readable lines.
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                lines.append(
+                    "{}{}: {} calls, {:.2f}s total, p50 {:.3f}s, p99 {:.3f}s, "
+                    "max {:.3f}s".format(
+                        name, _labels(labels), h["count"], h["sum"],
+                        self.quantile(h, 0.5), self.quantile(h, 0.99), h["max"]))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{}{}: {}".format(name, _labels(labels), value))
+        for name, cache in sorted(self.caches.items()):
+            stats = cache.stats()
+            lines.append("cache {}: {} hits, {} misses, {:.0%} hit rate".format(
+                name, stats["hits"], stats["misses"], stats["hit_rate"]))
+        return "\n".join(lines)
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in pairs) + "}"
+
+
+class SharedMetrics(object):
+    """
+    The histograms and counters of every process, kept in SQLite so that the
+    web workers and the cron sync add up to one set of figures, with the
+    summary of the last sync run.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._lock = threading.Lock()
+        self.db = connect(self.path)
+        with self._lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metrics (name TEXT, labels TEXT, "
+                "field TEXT, value REAL, PRIMARY KEY (name, labels, field))")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metric_runs (name TEXT PRIMARY KEY, "
+                "finished REAL, status TEXT, seconds REAL, first_invoice REAL, "
+                "invoices INTEGER, errors INTEGER, summary TEXT)")
+
+    def add(self, delta):
+        """
+        Add the figures of a registry to the totals.
+        """
+        rows = []
+        for (name, labels), h in delta.histograms.items():
+            labels = json.dumps(labels)
+            for bound, count in zip(Metrics.BUCKETS, h["buckets"]):
+                rows.append((name, labels, "le={}".format(bound), count))
+            rows.append((name, labels, "count", h["count"]))
+            rows.append((name, labels, "sum", h["sum"]))
+        for (name, labels), value in delta.counters.items():
+            rows.append((name, json.dumps(labels), "value", value))
+        maxima = [
+            (name, json.dumps(labels), "max", h["max"])
+            for (name, labels), h in delta.histograms.items()]
+        if not rows:
+            return
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO metrics VALUES (?, ?, ?, 0)",
+                [row[:3] for row in rows + maxima])
+            self.db.executemany(
+                "UPDATE metrics SET value=value+? WHERE name=? AND labels=? AND field=?",
+                [(row[3],) + row[:3] for row in rows])
+            self.db.executemany(
+                "UPDATE metrics SET value=MAX(value, ?) WHERE name=? AND labels=? AND field=?",
+                [(row[3],) + row[:3] for row in maxima])
+
+    def registry(self):
+        """
+        The totals as a `Metrics`, for rendering.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT name, labels, field, value FROM metrics").fetchall()
+        registry = Metrics()
+        buckets = ["le={}".format(bound) for bound in Metrics.BUCKETS]
+        for name, labels, field, value in rows:
+            key = (name, tuple(tuple(pair) for pair in json.loads(labels)))
+            if value == int(value):
+                value = int(value)
+            if field == "value":
+                registry.counters[key] = value
+                continue
+            h = registry.histograms.setdefault(key, {
+                "buckets": [0] * len(Metrics.BUCKETS), "count": 0, "sum": 0.0,
+                "max": 0.0})
+            if field in buckets:
+                h["buckets"][buckets.index(field)] = value
+            else:
+                h[field] = value
+        return registry
+
+    def record_run(self, delta, status, seconds, first_invoice=None, errors=0):
+        """
+        Keep the summary of a sync run, given the figures it recorded.
+        """
+        invoices = sum(
+            value for (name, labels), value in delta.counters.items()
+            if name == "sync_invoices_total")
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metric_runs VALUES ('last', ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), status, seconds, first_invoice, invoices, errors,
+                 delta.summary()))
+
+    def last_run(self):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT finished, status, seconds, first_invoice, invoices, errors, "
+                "summary FROM metric_runs WHERE name='last'").fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ("finished", "status", "seconds", "first_invoice", "invoices", "errors",
+             "summary"), row))
+
+    def render(self):
+        """
+        Format the totals and the last sync run for a Prometheus scrape. The
+        summary of the run follows as comments, for reading a slow night.
+        """
+        text = self.registry().render()
+        run = self.last_run()
+        if run is None:
+            return text
+        lines = [
+            "sync_last_run_timestamp_seconds {}".format(run["finished"]),
+            "sync_last_run_seconds {}".format(run["seconds"]),
+            "sync_last_run_invoices {}".format(run["invoices"]),
+            "sync_last_run_errors {}".format(run["errors"]),
+            "sync_last_run_failed {}".format(int(run["status"] != "complete")),
+        ]
+        if run["first_invoice"] is not None:
+            lines.append("sync_last_run_first_invoice_seconds {}".format(run["first_invoice"]))
+        lines.append("# Last sync run: {}, {} invoices, {} errors in {:.1f}s".format(
+            run["status"], run["invoices"], run["errors"], run["seconds"]))
+        lines.extend("# " + line for line in run["summary"].splitlines())
+        return text + "".join(line + "\n" for line in lines)
+
+    def close(self):
+        self.db.close()
+
+
+class RunReport(object):
+    """
+    Publish the metrics of one sync run to the `SharedMetrics` in the sync
+    database, where /metrics reads them whichever process serves the scrape.
+    """
+    def __init__(self, path=None):
+        self.shared = SharedMetrics(path)
+        # Flush what this process recorded before, so the rest is the run's
+        metrics.flush(self.shared)
+        self.started = time.time()
+
+    def finish(self, errors=None, first_invoice=None):
+        """
+        Publish the run, which failed if `errors` is None.
+        """
+        try:
+            self.shared.record_run(
+                metrics.flush(self.shared), "failed" if errors is None else "complete",
+                time.time() - self.started, first_invoice, len(errors or ()))
+        except Exception:
+            logger.exception("Could not publish the sync metrics")
+        finally:
+            self.shared.close()
+
+
+# The registry shared by the clients and the sync in this process
+metrics = Metrics()
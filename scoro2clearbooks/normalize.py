@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Normalize the text and country fields of Scoro records for ClearBooks.
+"""
+import html
+import logging
+import threading
+
+
+logger = logging.getLogger("normalize")
+
+
+# Names used in Scoro addresses that pycountry does not know
+COUNTRY_ALIASES = {
+    "UK": "GB",
+    "GREAT BRITAIN": "GB",
+    "ENGLAND": "GB",
+    "SCOTLAND": "GB",
+    "WALES": "GB",
+    "NORTHERN IRELAND": "GB",
+    "USA": "US",
+    "UNITED STATES OF AMERICA": "US",
+}
+
+
+def clean_text(s):
+    """
+    Reduce Scoro text to what ClearBooks accepts: HTML entities decoded,
+    Latin-1 only, with the pound sign spelled out.
+    """
+    if not s:
+        return ""
+    # Scoro returns text HTML-escaped; the SOAP serializer escapes it again
+    if "&" in s:
+        s = html.unescape(s)
+    # Most text is already Latin-1, and a strict encode checks that fastest
+    try:
+        s.encode("latin-1")
+    except UnicodeEncodeError:
+        s = s.encode("latin-1", "ignore").decode("latin-1")
+    return s.replace("£", "GBP") if "£" in s else s
+
+
+def name_key(name):
+    """
+    The form of a company name used to match customers: entities decoded,
+    case folded and runs of whitespace collapsed.
+    """
+    if not name:
+        return ""
+    if "&" in name:
+        name = html.unescape(name)
+    return " ".join(name.casefold().split())
+
+
+class CountryIndex(object):
+    """
+    Alpha-2 country codes by alpha-3 code, alpha-2 code, name and official
+    name. pycountry is only imported, and the index built, on first lookup.
+    """
+    def __init__(self, aliases=COUNTRY_ALIASES):
+        self.aliases = aliases
+        self._lock = threading.Lock()
+        self._codes = None
+
+    def _build(self):
+        import pycountry
+        codes = {}
+        for c in pycountry.countries:
+            for key in (c.name, getattr(c, "official_name", None), c.alpha3, c.alpha2):
+                if key:
+                    codes[key.upper()] = c.alpha2
+        codes.update(self.aliases)
+        return codes
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            with self._lock:
+                if self._codes is None:
+                    self._codes = self._build()
+        return self._codes
+
+    def get(self, country):
+        """
+        The alpha-2 code of a country, or "" if it is empty or unknown.
+        """
+        if not country:
+            return ""
+        code = self.codes.get(country.strip().upper())
+        if code is None:
+            logger.warning("Unknown country: {}".format(country))
+            return ""
+        return code
+
+
+countries = CountryIndex()
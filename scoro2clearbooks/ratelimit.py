@@ -0,0 +1,178 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from scoro2clearbooks.metrics import metrics
+
+
+logger = logging.getLogger("ratelimit")
+
+
+class TokenBucket(object):
+    """
+    Adaptive token bucket for one API host.
+
+    The rate is halved each time the host throttles us and creeps back up
+    towards the configured maximum with every successful call. Calls that
+    were already in flight when the host first pushed back are throttled
+    too, so the rate is halved at most once per `COOLDOWN` seconds.
+    """
+    COOLDOWN = 1.0
+
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.throttled_at = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token if a call may be made now, returning None. Otherwise
+        return the seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        """
+        Block until a call may be made.
+        """
+        while True:
+            wait = self.reserve()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            now = time.time()
+            self.tokens = 0.0
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if now - self.throttled_at < self.COOLDOWN:
+                return
+            self.throttled_at = now
+            self.rate = max(self.min_rate, self.rate / 2)
+        logger.warning("Throttled, rate lowered to {:.2f}/s".format(self.rate))
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter, honouring any Retry-After.
+
+    The HTTP sessions only send requests and wait; whether to send a request
+    again, and how long to wait first, is decided here for all of them.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # Statuses that mean the request was not processed, so even a write
+    # can safely be sent again
+    UNPROCESSED_STATUSES = (429, 503)
+
+    RETRIES = 4
+
+    def __init__(self, retries=None, backoff=0.5, max_backoff=30.0):
+        self.retries = self.RETRIES if retries is None else retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def should_retry(self, status, idempotent):
+        if idempotent:
+            return status in self.RETRY_STATUSES
+        return status in self.UNPROCESSED_STATUSES
+
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def response_wait(self, bucket, url, status, attempt, idempotent, retry_after=None):
+        """
+        Note a response in the bucket of its host, and return the seconds to
+        wait before sending the request again, or None if the response is
+        the answer. Calls that are not idempotent are only sent again when
+        the server cannot have acted on them.
+        """
+        if status == 429:
+            bucket.throttled(retry_after)
+        if self.should_retry(status, idempotent) and attempt < self.retries:
+            logger.info("Retry {} after HTTP {}".format(url, status))
+            metrics.inc("http_retries_total", host=urlparse(url).netloc, reason=status)
+            return self.delay(attempt, retry_after)
+        if status < 400:
+            bucket.succeeded()
+        return None
+
+    def error_wait(self, url, error, attempt, safe):
+        """
+        The seconds to wait before sending a request again after a
+        connection error or timeout, or None if it must not be sent again.
+        `safe` tells whether the request cannot have reached the server, or
+        may be repeated anyway.
+        """
+        if not safe or attempt >= self.retries:
+            return None
+        metrics.inc(
+            "http_retries_total", host=urlparse(url).netloc, reason=type(error).__name__)
+        return self.delay(attempt)
+
+
+def retry_after(response):
+    """
+    Read the Retry-After header, in seconds or as an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(host, rate):
+    """
+    Return the token bucket shared by every client calling a host.
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket(rate)
+        return bucket
+
+
+def reset_buckets():
+    """
+    Forget the buckets, e.g. before a process starts syncing another account.
+    """
+    with _buckets_lock:
+        _buckets.clear()
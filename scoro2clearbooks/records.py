@@ -0,0 +1,169 @@
+"""
+Compact records for the invoices, lines and contacts read from Scoro and
+the customers and invoices written to ClearBooks.
+
+Only the fields the sync uses are kept, in slots rather than a dict, so a
+record is a fraction of the size of the JSON it was read from and the rest
+of the response can be freed as soon as it is parsed.
+"""
+
+
+class Record(object):
+    """
+    A fixed set of fields, given by keyword. Fields not given are None.
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("Unknown {} fields: {}".format(
+                type(self).__name__, ", ".join(sorted(fields))))
+
+    def as_dict(self):
+        """
+        The fields as plain JSON-ready values, e.g. for the dry run plan.
+        """
+        return {name: _plain(getattr(self, name)) for name in self.__slots__}
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def _plain(value):
+    if isinstance(value, Record):
+        return value.as_dict()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+class Line(Record):
+    """
+    A line of a Scoro invoice.
+    """
+    __slots__ = (
+        "product_id", "amount", "price", "vat", "sum", "comment",
+        "finance_object_id")
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            product_id=data.get("product_id"),
+            amount=data.get("amount"),
+            price=data.get("price"),
+            vat=data.get("vat"),
+            sum=data.get("sum", 0.0),
+            comment=data.get("comment", ""),
+            finance_object_id=data.get("finance_object_id"))
+
+
+class Invoice(Record):
+    """
+    A Scoro invoice with its lines. The project code and name are filled in
+    from the project before mapping.
+    """
+    __slots__ = (
+        "id", "no", "date", "deadline", "description", "discount", "sum",
+        "company_id", "project_id", "clearbooks_ref", "lines",
+        "project_code", "project_name")
+
+    @classmethod
+    def from_json(cls, data):
+        custom = data.get("custom_fields")
+        if not isinstance(custom, dict):
+            custom = {}
+        return cls(
+            id=data.get("id"),
+            no=data.get("no"),
+            date=data.get("date"),
+            deadline=data.get("deadline"),
+            description=data.get("description", ""),
+            discount=data.get("discount", 0.0),
+            sum=data.get("sum", 0.0),
+            company_id=data.get("company_id"),
+            project_id=data.get("project_id", "0"),
+            clearbooks_ref=custom.get("c_clearbooksref", ""),
+            lines=[Line.from_json(l) for l in data.get("lines") or []],
+            project_code="",
+            project_name=None)
+
+
+class Contact(Record):
+    """
+    A Scoro company or person, with only its first address and the first of
+    each means of contact.
+    """
+    __slots__ = (
+        "contact_id", "contact_type", "name", "lastname", "street", "city",
+        "county", "country", "zipcode", "email", "phone1", "phone2", "fax",
+        "website")
+
+    @classmethod
+    def from_json(cls, data):
+        addresses = data.get("addresses") or []
+        a = addresses[0] if addresses else {}
+        contact = data.get("means_of_contact")
+        if not isinstance(contact, dict):
+            contact = {}
+        phones = contact.get("phone") or []
+        return cls(
+            contact_id=data.get("contact_id"),
+            contact_type=data.get("contact_type"),
+            name=data.get("name"),
+            lastname=data.get("lastname"),
+            street=a.get("street", ""),
+            city=a.get("city"),
+            county=a.get("county"),
+            country=a.get("country"),
+            zipcode=a.get("zipcode"),
+            email=_first(contact.get("email")),
+            phone1=_first(phones),
+            phone2=phones[1] if len(phones) > 1 else "",
+            fax=_first(contact.get("fax")),
+            website=_first(contact.get("website")))
+
+
+def _first(values):
+    return values[0] if values else ""
+
+
+class Project(Record):
+    """
+    The fields of a Scoro project copied onto its invoices.
+    """
+    __slots__ = ("project_name", "description")
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            project_name=data.get("project_name", ""),
+            description=data.get("description", ""))
+
+
+class ClearBooksCustomer(Record):
+    """
+    The entity sent to ClearBooks for a new customer.
+    """
+    __slots__ = (
+        "company_name", "contact_name", "building", "address1", "address2",
+        "town", "county", "country", "postcode", "email", "phone1", "phone2",
+        "fax", "website", "external_id")
+
+
+class ClearBooksItem(Record):
+    """
+    A line of a ClearBooks invoice.
+    """
+    __slots__ = ("unitPrice", "quantity", "description", "type", "vatRate")
+
+
+class ClearBooksInvoice(Record):
+    """
+    The invoice sent to ClearBooks.
+    """
+    __slots__ = (
+        "invoice_number", "entityId", "dateCreated", "dateDue", "description",
+        "creditTerms", "reference", "type", "items")
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
-import requests
 import json
 import logging
-import pycountry
-import html
-from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from scoro2clearbooks.cache import LRUCache, Memo
+from scoro2clearbooks.metrics import metrics
+from scoro2clearbooks.normalize import clean_text, countries
+from scoro2clearbooks.records import (
+    ClearBooksCustomer, ClearBooksInvoice, ClearBooksItem, Contact, Invoice,
+    Project, Record)
+from scoro2clearbooks.session import HTTPSession
 
 
 logger = logging.getLogger("scoro")
@@ -13,24 +17,60 @@ logger = logging.getLogger("scoro")
 FROM_DATE = "2016-09-01"
 
 
+def _is_record(value):
+    return isinstance(value, Record)
+
+
 class Scoro(object):
     """
     Interact with the Scoro API.
     """
     PER_PAGE = 40
-    products = {}
-    product_groups = {}
-    finance_objects = {}
-
-    def __init__(self, base_url, company_account_id, api_key, lang="eng"):
+    CONCURRENCY = 4
+    RATE = 20
+    CACHE_SIZE = 5000
+    # Above this many missing products, read the whole list instead of views
+    BULK_THRESHOLD = 40
+
+    def __init__(self, base_url, company_account_id, api_key, lang="eng",
+                 concurrency=None, per_page=None, pool_size=None, timeout=None,
+                 store=None, cache_size=None, cache_ttl=None, rate=None,
+                 retries=None):
         self.base_url = base_url
+        self.store = store
+        self.per_page = per_page or self.PER_PAGE
+        self.http = HTTPSession(
+            concurrency or self.CONCURRENCY, pool_size=pool_size, timeout=timeout,
+            rate=rate or self.RATE, retries=retries)
         self.auth = {
             "company_account_id": company_account_id,
             "apiKey": api_key,
             "lang": lang,
-            "per_page": self.PER_PAGE,
+            "per_page": self.per_page,
         }
 
+        # Lookups are cached per instance, so each tenant has its own
+        cache_size = cache_size or self.CACHE_SIZE
+        self.products = LRUCache(cache_size, ttl=cache_ttl)
+        self.product_groups = LRUCache(cache_size, ttl=cache_ttl)
+        self.catalog_size = None
+        self.finance_objects = LRUCache(cache_size, ttl=cache_ttl)
+        metrics.track_cache("products", self.products)
+        metrics.track_cache("product_groups", self.product_groups)
+        metrics.track_cache("finance_objects", self.finance_objects)
+
+        # Many invoices in a run share a company or project, so each is
+        # fetched once per run; errors come back as strings and are not kept
+        self.contacts = Memo(keep=_is_record)
+        self.projects = Memo(keep=_is_record)
+        metrics.track_cache("contacts", self.contacts)
+        metrics.track_cache("projects", self.projects)
+
+        # Products and groups rarely change, so reuse them between runs
+        if store:
+            self.products.update(store.load("products", dict))
+            self.product_groups.update(store.load("product_groups", dict))
+
     def _url(self, method, action=None, record_id=None):
         url = self.base_url + method
         if action:
@@ -39,16 +79,90 @@ class Scoro(object):
             url += "/" + str(record_id)
         return url
 
-    def fetch(self, method, action=None, record_id=None, options=None):
+    def _request(self, method, action=None, record_id=None, options=None):
+        """
+        The URL and JSON body of an API call.
+        """
         url = self._url(method, action=action, record_id=record_id)
         payload = self.auth.copy()
         if options:
             payload.update(options)
+        return url, json.dumps(payload)
 
-        response = requests.post(url, data=json.dumps(payload))
-        results = response.json()
+    def fetch(self, method, action=None, record_id=None, options=None):
+        url, data = self._request(method, action, record_id, options)
+        action = action or "list"
+        with metrics.timer("scoro_request_seconds", method=method, action=action):
+            response = self.http.post(url, data=data)
+            results = response.json()
+        metrics.inc("scoro_bytes_sent_total", len(data), method=method, action=action)
+        metrics.inc(
+            "scoro_bytes_received_total", len(response.content),
+            method=method, action=action)
         return self.check_error(results)
 
+    def fetch_pages(self, method, action=None, options=None, per_page=None,
+                    key=None, prefetch=True):
+        """
+        Stream the records of a list endpoint, one page at a time.
+
+        While the current page is being consumed the next one is requested in
+        the background. If a key is given, records are de-duplicated on it and
+        the pages are swept again until a sweep finds nothing new. This is
+        needed when processing the records takes them out of the result set,
+        which shifts the later records onto pages that have already been read.
+
+        Raises ValueError with the message of a page Scoro answers with an
+        error.
+        """
+        per_page = per_page or self.per_page
+
+        def page(number):
+            opts = dict(options or {})
+            opts.update({"page": number, "per_page": per_page})
+            return self.fetch(method, action=action, options=opts)
+
+        seen = set()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            while True:
+                new = 0
+                number = 1
+                # The first page of a sweep is never prefetched, so the end
+                # of the result set is judged on an up-to-date read
+                pending = None
+                while True:
+                    if pending:
+                        status, records = pending.result()
+                    else:
+                        status, records = page(number)
+                    # An error must not pass for the end of the listing
+                    if not status:
+                        raise ValueError(records)
+                    if not records:
+                        break
+
+                    last = len(records) < per_page
+                    pending = None
+                    if prefetch and not last:
+                        pending = pool.submit(page, number + 1)
+
+                    for r in records:
+                        if key:
+                            if r[key] in seen:
+                                continue
+                            seen.add(r[key])
+                        new += 1
+                        yield r
+
+                    if last:
+                        break
+                    number += 1
+
+                if pending:
+                    pending.result()
+                if not key or new == 0:
+                    return
+
     def check_error(self, results):
         if results["status"] == "OK":
             return True, results.get("data")
@@ -56,10 +170,21 @@ class Scoro(object):
             logger.error(results)
             return False, results.get("message")
 
-    def invoices(self):
+    def invoices(self, per_page=None, modified_since=None):
         """
-        Fetch the invoices that need to be transferred to the accounts system.
+        Stream the invoices that need to be transferred to the accounts system,
+        optionally only those changed since a point in time.
         """
+        options = self._invoices_options(modified_since)
+        # Transferred invoices drop out of the filter, so de-duplicate on id
+        count = 0
+        for record in self.fetch_pages(
+                "invoices", options=options, per_page=per_page, key="id"):
+            count += 1
+            yield record
+        logger.info("Found {0} invoices".format(count))
+
+    def _invoices_options(self, modified_since=None):
         logger.info("Fetch unpaid invoices")
         options = {
             "filter": {
@@ -67,168 +192,267 @@ class Scoro(object):
                 "date": {"from": FROM_DATE},
             }
         }
-        status, records = self.fetch("invoices", options=options)
-        logger.info("Found {0} invoices".format(len(records)))
-        return records
+        if modified_since:
+            logger.info("Only invoices modified since {}".format(modified_since))
+            options["filter"]["modified_date"] = {"from": modified_since}
+        return options
+
+    def needs_transfer(self, invoice):
+        """
+        Whether a full invoice still matches the filter used by `invoices`.
+        """
+        return not invoice.clearbooks_ref and (invoice.date or "") >= FROM_DATE
+
+    def view(self, method, record_id, record):
+        """
+        Fetch a single record and parse it with `record.from_json`. If it
+        cannot be read the error message is returned instead.
+        """
+        data = self.fetch(method, action="view", record_id=record_id)[1]
+        return record.from_json(data) if isinstance(data, dict) else data
 
     def invoice(self, record_id):
         """
         Fetch a specific invoice, which will include the lines.
         """
-        return self.fetch("invoices", action="view", record_id=record_id)[1]
+        return self.view("invoices", record_id, Invoice)
 
     def contact(self, record_id):
         """
-        Fetch a single customer or contact record.
+        Fetch a single customer or contact record, once per run.
         """
-        return self.fetch("contacts", action="view", record_id=record_id)[1]
+        return self.contacts.get(
+            str(record_id), lambda: self.view("contacts", record_id, Contact))
 
     def project(self, record_id):
         """
-        Fetch a single project record.
+        Fetch a single project record, once per run.
+        """
+        return self.projects.get(
+            str(record_id), lambda: self.view("projects", record_id, Project))
+
+    def clear_lookups(self):
+        """
+        Forget the contacts and projects, so the next run reads them afresh.
         """
-        return self.fetch("projects", action="view", record_id=record_id)[1]
+        self.contacts.clear()
+        self.projects.clear()
 
     def product(self, record_id):
         """
         Fetch a single product record.
         """
-        if record_id in self.products:
-            return self.products[record_id]
+        key = str(record_id)
+        product = self.products.get(key)
+        if product is not None:
+            return product
         else:
             p = self.fetch("products", action="view", record_id=record_id)[1]
-            self.products[record_id] = {"name": p["name"]}
+            return self._cache_product(key, p)
+
+    def _cache_product(self, key, p):
+        return self._cache_products({key: p})[key]
+
+    def _cache_products(self, records):
+        products = {}
+        for key, p in records.items():
+            product = {"name": p["name"]}
 
             # Get the product group
             if p.get("productgroup_id") and p.get("productgroup_id") != "0":
-                grp = self.product_group(p["productgroup_id"])
-                self.products[record_id]["group"] = grp
-            return self.products[record_id]
+                product["group"] = self.product_group(p["productgroup_id"])
+
+            self.products.set(key, product)
+            products[key] = product
+        if self.store and products:
+            self.store.put_many("products", products)
+        return products
 
     def product_group(self, record_id):
         """
         Fetch a single product group record.
         """
-        if record_id in self.product_groups:
-            return self.product_groups[record_id]
+        key = str(record_id)
+        name = self.product_groups.get(key)
+        if name is not None:
+            return name
         else:
             p = self.fetch("productGroups", action="view", record_id=record_id)[1]
-            self.product_groups[record_id] = p["name"]
-            return self.product_groups[record_id]
+            return self._cache_product_group(key, p["name"])
+
+    def _cache_product_group(self, key, name):
+        self._cache_product_groups({key: name})
+        return name
+
+    def _cache_product_groups(self, names):
+        for key, name in names.items():
+            self.product_groups.set(key, name)
+        if self.store and names:
+            self.store.put_many("product_groups", names)
+
+    def prefetch_products(self, product_ids):
+        """
+        Load the products, and their groups, for a batch of invoice lines so
+        that mapping the invoices needs no further API calls.
+
+        A handful of missing products are fetched with concurrent views; when
+        many are missing, and the catalog fits in the cache, the product and
+        group lists are read instead.
+        """
+        missing = self._missing_products(product_ids)
+        if not missing:
+            return
+
+        logger.info("Prefetch {} products".format(len(missing)))
+        if self._bulk(missing):
+            self._cache_catalog(
+                self.fetch_pages("productGroups", action="list"),
+                self.fetch_pages("products", action="list"), missing)
+            return
+
+        def view(record_id):
+            return self.fetch("products", action="view", record_id=record_id)[1]
+
+        with ThreadPoolExecutor(max_workers=self.http.concurrency) as pool:
+            records = {
+                key: p for key, p in zip(missing, pool.map(view, missing))
+                if isinstance(p, dict)}
+
+            # Groups are fetched up front too, so caching the products is quick
+            list(pool.map(self.product_group, self._missing_groups(records.values())))
+
+        self._cache_products(records)
+
+    def _bulk(self, missing):
+        # The size of the catalog is only known once it has been listed
+        return len(missing) > self.BULK_THRESHOLD and (
+            self.catalog_size is None or self.catalog_size <= self.products.maxsize)
+
+    def _cache_catalog(self, groups, products, missing):
+        """
+        Cache the product and group lists. A catalog bigger than the cache
+        only tops up the missing products, rather than evicting those in use.
+        """
+        names = {str(g["productgroup_id"]): g["name"] for g in groups}
+        records = {str(p["product_id"]): p for p in products}
+        self.catalog_size = len(records)
+        if len(records) > self.products.maxsize:
+            logger.info("{} products do not fit in the cache of {}".format(
+                len(records), self.products.maxsize))
+            records = {key: records[key] for key in missing if key in records}
+            used = {str(p.get("productgroup_id")) for p in records.values()}
+            names = {key: name for key, name in names.items() if key in used}
+        self._cache_product_groups(names)
+        self._cache_products(records)
+
+    def _missing_products(self, product_ids):
+        missing = {str(p) for p in product_ids if str(p) not in self.products}
+        missing.discard("-1")
+        return missing
+
+    def _missing_groups(self, products):
+        groups = {
+            str(p["productgroup_id"]) for p in products
+            if p.get("productgroup_id") and p.get("productgroup_id") != "0"}
+        return [g for g in groups if g not in self.product_groups]
 
     def accounting_object(self, record_id):
         """
         Fetch a single accounting object record.
         """
-        if record_id in self.finance_objects:
-            return self.finance_objects[record_id]
+        key = str(record_id)
+        name = self.finance_objects.get(key)
+        if name is not None:
+            return name
         else:
             p = self.fetch("financeObjects", action="view", record_id=record_id)[1]
-            self.finance_objects[record_id] = p["name"]
-            return self.finance_objects[record_id]
+            self.finance_objects.set(key, p["name"])
+            if self.store:
+                self.store.put("finance_objects", key, p["name"])
+            return p["name"]
 
-    def accounting_objects(self):
+    def accounting_objects(self, per_page=None, refresh=False):
         """
         Fetch all the accounting objects.
         """
-        response, accts = self.fetch("financeObjects", action="list")
-        if not response:
-            return {}
+        if self.store:
+            objects = self.store.load(
+                "finance_objects", lambda: self._accounting_objects(per_page),
+                refresh=refresh)
+        else:
+            objects = self._accounting_objects(per_page)
+        self.finance_objects.update(objects)
+        return objects
 
+    def _accounting_objects(self, per_page=None):
+        objects = {}
+        accts = self.fetch_pages("financeObjects", action="list", per_page=per_page)
         for a in accts:
             if a["name"]:
-                self.finance_objects[a["object_id"]] = a["name"].replace("&amp;", "&")
+                objects[str(a["object_id"])] = a["name"].replace("&amp;", "&")
             else:
-                self.finance_objects[a["object_id"]] = ""
-        return self.finance_objects
+                objects[str(a["object_id"])] = ""
+        return objects
+
+    def customer_name(self, c):
+        """
+        The ClearBooks company name of a Scoro customer record.
+        """
+        if c.contact_type == "person":
+            return self.clean_text("{0} {1}".format(c.name, c.lastname))
+        return self.clean_text(c.name)
 
     def clearbooks_customer(self, c):
         """
         Converts a Scoro customer record to a ClearBooks customer.
         """
-        if c.get("contact_type") == "person":
-            company = "{0} {1}".format(c.get("name"), c.get("lastname"))
-            contact_name = company
+        company = self.customer_name(c)
+        contact_name = company if c.contact_type == "person" else ""
+
+        # Split the address street
+        lines = (c.street or "").split("\r\n")
+        building = ""
+        address1 = lines[0]
+        if len(lines) > 1:
+            address2 = " ".join(lines[1:])
         else:
-            company = c.get("name")
-            contact_name = ""
-
-        if len(c.get("addresses", [])) == 0:
-            a = {}
-            building = ""
-            country = ""
-            address1 = ""
             address2 = ""
-            county = ""
-        else:
-            a = c["addresses"][0]
-
-            # Split the address street
-            lines = a.get("street", "").split("\r\n")
-            building = ""
-            address1 = lines[0]
-            if len(lines) > 1:
-                address2 = " ".join(lines[1:])
-            else:
-                address2 = ""
-            if len(lines) > 2:
-                building = lines[0]
-                address1 = lines[1]
-                address2 = " ".join(lines[2:])
-
+        if len(lines) > 2:
+            building = lines[0]
+            address1 = lines[1]
+            address2 = " ".join(lines[2:])
+
+        return ClearBooksCustomer(
+            company_name=company,
+            contact_name=contact_name,
+            building=self.clean_text(building),
+            address1=self.clean_text(address1),
+            address2=self.clean_text(address2),
+            town=self.clean_text(c.city),
+            county=self.clean_text(c.county),
             # Country codes need to be a two-character format
-            if a.get("country") and len(a.get("country")) > 0:
-                if a["country"] == "United Kingdom":
-                    a["country"] = "GBR"
-                country = pycountry.countries.get(alpha3=a.get("country").upper()).alpha2
-            else:
-                country = ""
-
-        # Contact details
-        contact = c.get("means_of_contact", {})
-        if not contact:
-            contact = {}
-        if isinstance(contact, list):
-            contact = {}
-        emails = contact.get("email", [])
-        email = emails[0] if len(emails) > 0 else ""
-        phones = contact.get("phone", [])
-        phone1 = phones[0] if len(phones) > 0 else ""
-        phone2 = phones[1] if len(phones) > 1 else ""
-        faxes = contact.get("fax", [])
-        fax = faxes[0] if len(faxes) > 0 else ""
-        websites = contact.get("website", [])
-        website = websites[0] if len(websites) > 0 else ""
-
-        return {
-            "company_name": self.clean_text(company),
-            "contact_name": self.clean_text(contact_name),
-            "building": self.clean_text(building),
-            "address1": self.clean_text(address1),
-            "address2": self.clean_text(address2),
-            "town": a.get("city"),
-            "county": a.get("county"),
-            "country": country,
-            "postcode": a.get("zipcode"),
-            "email": email,
-            "phone1": phone1,
-            "phone2": phone2,
-            "fax": fax,
-            "website": website,
-            "external_id": a.get("contact_id"),
-        }
+            country=countries.get(c.country),
+            postcode=self.clean_text(c.zipcode),
+            email=c.email,
+            phone1=c.phone1,
+            phone2=c.phone2,
+            fax=c.fax,
+            website=c.website,
+            # The contact id, as `Customers.get` looks customers up by it
+            external_id=c.contact_id,
+        )
 
     def clean_text(self, s):
-        return s.encode("latin-1", "ignore").decode("latin-1").replace("£", "GBP")
+        return clean_text(s)
 
     def clearbooks_discount(self, percent, amount):
-        return {
-            "unitPrice": amount,
-            "quantity": 1.0,
-            "description": "Discount {}%".format(percent),
-            "type": "3001001",
-            "vatRate": 0.0,
-        }
+        return ClearBooksItem(
+            unitPrice=amount,
+            quantity=1.0,
+            description="Discount {}%".format(percent),
+            type="3001001",
+            vatRate=0.0,
+        )
 
     def clearbooks_invoice(self, customer_id, i, clearbooks_accounts):
         """
@@ -237,85 +461,72 @@ class Scoro(object):
         items = []
         amount = 0.0
 
-        if not i.get("lines"):
-            return {
-                "invoice_number": i.get("no"),
-                "entityId": customer_id,
-                "dateCreated": i.get("date"),
-                "dateDue": i.get("deadline"),
-                "description": urlencode(self.clean_text(i.get("description", ""))),
-                "creditTerms": "30",
-                "reference": html.escape(self.clean_text(i.get("project_code", ""))[:255]),
-                "type": "sales",
-                "items": items,
-            }
-
-        for l in i.get("lines", []):
-            #print(l)
+        for l in i.lines:
             # Ignore invalid group lines with no value
-            if int(l["product_id"]) == -1 and l["amount"] == '0.000000':
+            if int(l.product_id) == -1 and l.amount == '0.000000':
                 continue
 
             # Get the product and create the description
-            prod = self.product(l["product_id"])
-            d = "{0}\n{1}".format(prod["name"], l.get("comment", ""))
+            prod = self.product(l.product_id)
+            d = "{0}\n{1}".format(prod["name"], l.comment)
 
             # Convert the finance object ID to a name
-            if l["finance_object_id"] == 0:
+            if l.finance_object_id == 0:
                 logger.info(
                     "Error: the Accounting Object is not set: %s: %s",
-                    i.get("no"),
-                    l.get("comment", ""))
-            acct_name = self.accounting_object(l["finance_object_id"])
+                    i.no,
+                    l.comment)
+            acct_name = self.accounting_object(l.finance_object_id)
 
             # Look up the account code from the ClearBooks dictionary
             # Default: Other Income = 3001001
-            print(acct_name)
+            logger.debug("Account: {}".format(acct_name))
             cb_acct_id = clearbooks_accounts.get(acct_name, "3001001")
 
 
-            items.append({
-                "unitPrice": l["price"],
-                "quantity": l["amount"],
-                "description": self.clean_text(prod["name"]),
-                "type": cb_acct_id,
-                "vatRate": float(l["vat"]) / 100.0,
-            })
-            amount += float(l.get("sum", 0.0))
+            items.append(ClearBooksItem(
+                unitPrice=l.price,
+                quantity=l.amount,
+                description=self.clean_text(prod["name"]),
+                type=cb_acct_id,
+                vatRate=float(l.vat) / 100.0,
+            ))
+            amount += float(l.sum)
 
-            if float(i.get("discount", 0.0)) > 0.0:
-                item = self.clearbooks_discount(i.get("discount"), float(i.get("sum", 0.0)) - amount)
+            if float(i.discount) > 0.0:
+                item = self.clearbooks_discount(i.discount, float(i.sum) - amount)
                 items.append(item)
 
-        return {
-            "invoice_number": i.get("no"),
-            "entityId": customer_id,
-            "dateCreated": i.get("date"),
-            "dateDue": i.get("deadline"),
-            "description": self.clean_text(i.get("description", "")),
-            "creditTerms": "30",
-            "reference": html.escape(self.clean_text(i.get("project_code", ""))[:255]),
-            "type": "sales",
-            "items": items,
-        }
+        return ClearBooksInvoice(
+            invoice_number=i.no,
+            entityId=customer_id,
+            dateCreated=i.date,
+            dateDue=i.deadline,
+            description=self.clean_text(i.description),
+            creditTerms="30",
+            reference=self.clean_text(i.project_code)[:255],
+            type="sales",
+            items=items,
+        )
 
     def update_invoice(self, invoice, cb_inv_no):
         """
         Update the custom field on the invoice with the number from ClearBooks.
+        Raises ValueError if Scoro rejects the update.
         """
-        # Remove the finance_account_id as finance accounts is unused
-        if invoice["lines"]:
-            lines = []
-            for l in invoice["lines"]:
-                if "finance_account_id" in l:
-                    del l["finance_account_id"]
-                lines.append(l)
-            invoice["lines"] = lines
-
-        invoice["custom_fields"]["c_clearbooksref"] = cb_inv_no
-        options = {
-            "request": invoice
-        }
-
-        return self.fetch(
-            "invoices", action="modify", record_id=invoice["id"], options=options)
+        return self.updated(invoice, self.fetch(
+            "invoices", action="modify", record_id=invoice.id,
+            options=self._invoice_update(cb_inv_no)))
+
+    def updated(self, invoice, result):
+        # Scoro answers a rejected write with an error status, not an HTTP error
+        status, data = result
+        if not status:
+            raise ValueError("Scoro did not update invoice {}: {}".format(
+                invoice.no, data))
+        return data
+
+    def _invoice_update(self, cb_inv_no):
+        # Scoro leaves the fields and custom fields not sent as they are, so
+        # the reference alone is sent however large the invoice
+        return {"request": {"custom_fields": {"c_clearbooksref": cb_inv_no}}}
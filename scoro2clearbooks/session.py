@@ -0,0 +1,87 @@
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from scoro2clearbooks.ratelimit import RetryPolicy, bucket_for, retry_after
+
+
+class HTTPSession(object):
+    """
+    Pooled, keep-alive HTTP session owned by one API client.
+
+    Calls are paced by a token bucket shared per host, and throttled or
+    failed calls are retried with backoff.
+    """
+    TIMEOUT = 60
+    RATE = 20
+
+    def __init__(self, concurrency, pool_size=None, timeout=None, rate=None,
+                 retries=None):
+        self.timeout = timeout or self.TIMEOUT
+        self.rate = rate or self.RATE
+        self.retry = RetryPolicy(retries)
+        self.session = requests.Session()
+        self.pool_size = pool_size or concurrency
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        # Limit the number of calls in flight at once
+        self.concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def post(self, url, idempotent=True, **kwargs):
+        """
+        Post a request, retrying throttled and transient failures. Calls that
+        are not idempotent are only retried when the server cannot have acted
+        on them.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = bucket_for(urlparse(url).netloc, self.rate)
+
+        # A callable body is a streamed payload, rebuilt for each attempt
+        data = kwargs.get("data")
+
+        attempt = 0
+        while True:
+            if callable(data):
+                kwargs["data"] = data()
+            bucket.acquire()
+            try:
+                with self._slots:
+                    response = self.session.post(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                safe = idempotent or isinstance(e, requests.ConnectTimeout)
+                wait = self.retry.error_wait(url, e, attempt, safe)
+                if wait is None:
+                    raise
+            else:
+                wait = self.retry.response_wait(
+                    bucket, url, response.status_code, attempt, idempotent,
+                    retry_after(response))
+                if wait is None:
+                    return response
+                response.close()
+            finally:
+                with self._lock:
+                    self.requests += 1
+            time.sleep(wait)
+            attempt += 1
+
+    def stats(self):
+        """
+        Report how many requests were sent and how many connections they used.
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        return {
+            "requests": self.requests,
+            "connections": connections,
+            "reused": max(self.requests - connections, 0),
+        }
+
+    def close(self):
+        self.session.close()
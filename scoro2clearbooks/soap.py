@@ -0,0 +1,140 @@
+"""
+Serialize the SOAP envelopes sent to ClearBooks.
+
+Payloads are built from lists of string parts joined once, so the cost is
+linear in the size of the invoice. Attribute values and text are always
+escaped and no indentation is emitted. An envelope can also be produced as a
+stream of byte chunks, to send large invoices without building them in
+memory first.
+"""
+from xml.sax.saxutils import escape
+
+
+NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
+NS_CLEARBOOKS = "https://secure.clearbooks.co.uk/api/accounting/soap/"
+NS_XSD = "http://www.w3.org/2001/XMLSchema"
+
+HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="{}" xmlns:ns1="{}" xmlns:xsd="{}">'
+    '<SOAP-ENV:Header><ns1:authenticate><apiKey>{{}}</apiKey></ns1:authenticate>'
+    '</SOAP-ENV:Header><SOAP-ENV:Body>').format(NS_SOAP, NS_CLEARBOOKS, NS_XSD)
+TAIL = '</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+# Parsers read a literal \r\n as \n, and in attributes turn line breaks and
+# tabs into spaces, so those characters are sent as references
+_TEXT_ENTITIES = {"\r": "&#13;"}
+_ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#9;"}
+
+CUSTOMER_FIELDS = (
+    "company_name", "building", "address1", "address2", "town", "county",
+    "country", "postcode", "email", "phone1", "phone2", "fax", "website",
+    "external_id")
+
+
+def text(value):
+    return escape("" if value is None else str(value), _TEXT_ENTITIES)
+
+
+def attributes(pairs):
+    """
+    Format `(name, value)` pairs as escaped, double-quoted XML attributes.
+    """
+    return "".join(
+        ' {}="{}"'.format(name, escape(
+            "" if value is None else str(value), _ATTRIBUTE_ENTITIES))
+        for name, value in pairs)
+
+
+def operation(name, inner=(), attrs=()):
+    """
+    Wrap the parts of a request in a ClearBooks operation element.
+    """
+    yield "<ns1:{}{}>".format(name, attributes(attrs))
+    for part in inner:
+        yield part
+    yield "</ns1:{}>".format(name)
+
+
+def query(name, attrs=()):
+    return operation(name, ["<query{}></query>".format(attributes(attrs))])
+
+
+def customer(c):
+    """
+    The parts of a createEntity operation for a `ClearBooksCustomer`.
+    """
+    return operation("createEntity", [
+        "<entity{}>".format(attributes((f, getattr(c, f)) for f in CUSTOMER_FIELDS)),
+        '<customer default_account_code="0" default_vat_rate="0.00" '
+        'default_credit_terms="30"/>',
+        "</entity>",
+    ])
+
+
+def invoice_items(items):
+    for i in items:
+        yield "<ns1:Item{}><description>{}</description></ns1:Item>".format(
+            attributes((
+                ("vatRate", i.vatRate),
+                ("project", "0"),
+                ("type", i.type),
+                ("quantity", i.quantity),
+                ("unitPrice", i.unitPrice),
+            )),
+            text(i.description))
+
+
+def invoice(inv):
+    """
+    The parts of a createInvoice operation for a `ClearBooksInvoice`. The lines
+    are produced lazily, one at a time.
+    """
+    def parts():
+        yield "<invoice{}><items>".format(attributes((
+            ("invoice_prefix", "INV"),
+            ("invoice_number", inv.invoice_number),
+            ("entityId", inv.entityId),
+            ("dateDue", inv.dateDue),
+            ("dateCreated", inv.dateCreated),
+            ("type", "sales"),
+            ("creditTerms", "30"),
+            ("project", "0"),
+            ("status", "approved"),
+        )))
+        for part in invoice_items(inv.items):
+            yield part
+        yield "</items><description>{}</description><reference>{}</reference>" \
+              "<type>sales</type></invoice>".format(
+                  text(inv.description), text(inv.reference))
+    return operation("createInvoice", parts())
+
+
+def envelope(api_key, operations):
+    """
+    Build a complete envelope around one or more operations.
+    """
+    parts = [HEAD.format(text(api_key))]
+    for op in operations:
+        parts.extend(op)
+    parts.append(TAIL)
+    return "".join(parts)
+
+
+def iter_envelope(api_key, operations, chunk_size=16 * 1024):
+    """
+    Produce an envelope as a stream of UTF-8 byte chunks of about
+    `chunk_size`, without holding the whole payload in memory.
+    """
+    buffer = [HEAD.format(text(api_key))]
+    size = len(buffer[0])
+    for op in operations:
+        for part in op:
+            buffer.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                size = 0
+    buffer.append(TAIL)
+    yield "".join(buffer).encode("utf-8")
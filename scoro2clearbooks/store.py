@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+
+
+logger = logging.getLogger("store")
+
+
+class ReferenceStore(object):
+    """
+    On-disk cache of the reference data used by the sync, kept in SQLite.
+
+    Each table is a key/value map stamped with the time it was last loaded in
+    full. A table is served from disk while that stamp is within the table's
+    TTL; single records can be topped up at any time without a full reload.
+    """
+    HOUR = 60 * 60
+    TTL = {
+        "customers": HOUR,
+        "account_codes": 24 * HOUR,
+        "finance_objects": 24 * HOUR,
+        "products": 7 * 24 * HOUR,
+        "product_groups": 7 * 24 * HOUR,
+    }
+
+    def __init__(self, path=None, ttl=None, refresh=()):
+        self.path = path or default_path()
+        self.ttl = dict(self.TTL)
+        self.ttl.update(ttl or {})
+        # Tables to reload from the APIs on first use, regardless of age
+        self.refresh = set(self.ttl) if "all" in refresh else set(refresh)
+
+        self._lock = threading.Lock()
+        self.db = connect(self.path)
+        with self._lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "tbl TEXT, key TEXT, value TEXT, PRIMARY KEY (tbl, key))")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS loads (tbl TEXT PRIMARY KEY, loaded REAL)")
+
+    def fresh(self, table):
+        """
+        Check if a table was loaded in full within its TTL.
+        """
+        if table in self.refresh:
+            return False
+        with self._lock:
+            row = self.db.execute(
+                "SELECT loaded FROM loads WHERE tbl=?", (table,)).fetchone()
+        return bool(row) and time.time() - row[0] < self.ttl.get(table, 0)
+
+    def get(self, table):
+        """
+        Return the cached records of a table, or None if it is stale.
+        """
+        if not self.fresh(table):
+            return None
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT key, value FROM entries WHERE tbl=?", (table,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def load(self, table, fetch, refresh=False):
+        """
+        Return a table from disk, or call `fetch` and store the result if the
+        table is stale or a refresh is forced.
+        """
+        records = None if refresh else self.get(table)
+        if records is not None:
+            logger.info("Using cached {} ({} records)".format(table, len(records)))
+            return records
+
+        records = fetch()
+        self.replace(table, records)
+        return records
+
+    def replace(self, table, records):
+        """
+        Replace the contents of a table and mark it as freshly loaded.
+        """
+        rows = [(table, str(k), json.dumps(v)) for k, v in records.items()]
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM entries WHERE tbl=?", (table,))
+            self.db.executemany("INSERT INTO entries VALUES (?, ?, ?)", rows)
+            self.db.execute(
+                "INSERT OR REPLACE INTO loads VALUES (?, ?)", (table, time.time()))
+        self.refresh.discard(table)
+
+    def put(self, table, key, value):
+        """
+        Top up a single record without changing the age of the table.
+        """
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                (table, str(key), json.dumps(value)))
+
+    def put_many(self, table, records):
+        """
+        Top up many records in one transaction, like `put`.
+        """
+        rows = [(table, str(k), json.dumps(v)) for k, v in records.items()]
+        with self._lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows)
+
+    def invalidate(self, table=None):
+        """
+        Mark one table, or all of them, as stale.
+        """
+        with self._lock, self.db:
+            if table:
+                self.db.execute("DELETE FROM loads WHERE tbl=?", (table,))
+            else:
+                self.db.execute("DELETE FROM loads")
+
+    def close(self):
+        self.db.close()
+
+
+class Checkpoint(object):
+    """
+    Progress of the sync, so that a run only asks Scoro for invoices changed
+    since the last clean run and can resume after a crash.
+
+    The modified-since mark only moves forward when a run finishes without
+    errors, so failed invoices are picked up again by the next run.
+    """
+    # Allow for clock differences between this host and Scoro
+    MARGIN = 60 * 60
+    FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._lock = threading.Lock()
+        self.db = connect(self.path)
+        with self._lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_done (invoice_id TEXT PRIMARY KEY)")
+
+    def _get(self, name):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT value FROM checkpoint WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, db, name, value):
+        db.execute("INSERT OR REPLACE INTO checkpoint VALUES (?, ?)", (name, value))
+
+    @property
+    def modified_since(self):
+        return self._get("modified_since")
+
+    @property
+    def last_invoice(self):
+        return self._get("last_invoice_date"), self._get("last_invoice_id")
+
+    def begin(self):
+        """
+        Start a run, noting if the previous one did not finish.
+        """
+        if self._get("run_started"):
+            date, invoice_id = self.last_invoice
+            logger.info("Resuming unfinished sync after invoice {} ({})".format(
+                invoice_id, date))
+        started = time.strftime(self.FORMAT, time.localtime(time.time() - self.MARGIN))
+        with self._lock, self.db:
+            self._set(self.db, "run_started", started)
+
+    def is_done(self, invoice_id):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT 1 FROM checkpoint_done WHERE invoice_id=?",
+                (str(invoice_id),)).fetchone()
+        return bool(row)
+
+    def done(self, invoice_id, date):
+        """
+        Record an invoice that has been transferred.
+        """
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO checkpoint_done VALUES (?)", (str(invoice_id),))
+            row = self.db.execute(
+                "SELECT value FROM checkpoint WHERE name='last_invoice_date'").fetchone()
+            if not row or (date or "") >= row[0]:
+                self._set(self.db, "last_invoice_date", date or "")
+                self._set(self.db, "last_invoice_id", str(invoice_id))
+
+    def finish(self, clean):
+        """
+        End a run. A clean run moves the modified-since mark forward.
+        """
+        started = self._get("run_started")
+        with self._lock, self.db:
+            if clean and started:
+                self._set(self.db, "modified_since", started)
+            self.db.execute("DELETE FROM checkpoint WHERE name='run_started'")
+            self.db.execute("DELETE FROM checkpoint_done")
+
+    def reset(self):
+        """
+        Forget all progress, so the next run scans every invoice again.
+        """
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM checkpoint")
+            self.db.execute("DELETE FROM checkpoint_done")
+
+    def close(self):
+        self.db.close()
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+def default_path():
+    data_dir = os.environ.get("OPENSHIFT_DATA_DIR", tempfile.gettempdir())
+    return os.path.join(data_dir, "scorosync.db")
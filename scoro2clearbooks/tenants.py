@@ -0,0 +1,164 @@
+"""
+Sync many Scoro and ClearBooks account pairs from one deployment.
+
+The tenants are listed in a JSON file named by SYNC_TENANTS:
+
+    [
+        {"name": "acme",
+         "SCORO_BASE_URL": "https://acme.scoro.com/api/v1/",
+         "SCORO_API_KEY": "...", "SCORO_ACCOUNT_ID": "acme",
+         "CLEARBOOKS_API_KEY": "...",
+         "SYNC_WORKERS": "4"},
+        ...
+    ]
+
+Apart from the name, each entry holds the same variables as a single
+deployment. Settings missing from an entry come from the process environment,
+except the account credentials, which every tenant must give.
+"""
+import os
+import re
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scoro2clearbooks.jobs import SyncLock
+from scoro2clearbooks.metrics import metrics
+from scoro2clearbooks.ratelimit import reset_buckets
+from scoro2clearbooks.store import Checkpoint, default_path
+from scoro2clearbooks.utils import run_sync, _read_config
+
+
+logger = logging.getLogger("tenants")
+
+
+# Settings that must not be inherited from the environment by a tenant
+ACCOUNT_KEYS = ("SCORO_BASE_URL", "SCORO_API_KEY", "SCORO_ACCOUNT_ID", "CLEARBOOKS_API_KEY")
+
+_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class Tenant(object):
+    """
+    One Scoro and ClearBooks account pair, with its own cache and checkpoint.
+    """
+    def __init__(self, name, settings):
+        self.name = name
+        self.env = dict(os.environ)
+        for key in ACCOUNT_KEYS:
+            self.env.pop(key, None)
+        self.env.update((k, str(v)) for k, v in settings.items())
+        if "SYNC_CACHE_PATH" not in settings:
+            base, ext = os.path.splitext(default_path())
+            self.env["SYNC_CACHE_PATH"] = "{}-{}{}".format(base, name, ext)
+
+    @property
+    def cache_path(self):
+        return self.env["SYNC_CACHE_PATH"]
+
+    def config(self):
+        return _read_config(self.env)
+
+    def last_synced(self):
+        """
+        When the last clean run started, or "" if there has not been one.
+        """
+        checkpoint = Checkpoint(self.cache_path)
+        try:
+            return checkpoint.modified_since or ""
+        finally:
+            checkpoint.close()
+
+
+def load_tenants(path):
+    """
+    Read the tenant list, checking that every tenant has a unique name and its
+    own credentials.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+
+    tenants = []
+    names = set()
+    for entry in entries:
+        settings = dict(entry)
+        name = str(settings.pop("name", ""))
+        if not _NAME.match(name):
+            raise ValueError("Invalid tenant name: {!r}".format(name))
+        if name in names:
+            raise ValueError("Duplicate tenant: {}".format(name))
+        missing = [k for k in ACCOUNT_KEYS if not settings.get(k)]
+        if missing:
+            raise ValueError("Tenant {} is missing {}".format(name, ", ".join(missing)))
+        names.add(name)
+        tenants.append(Tenant(name, settings))
+    return tenants
+
+
+def sync_tenant(tenant, full_scan=None, dry_run=False):
+    """
+    Run the sync of one tenant and report how it went. This runs in a worker
+    process, so the result is a plain dict, which holds the plan of a dry run.
+    """
+    # A worker process syncs several tenants in turn, so start each afresh
+    metrics.reset()
+    reset_buckets()
+
+    result = {"tenant": tenant.name, "errors": [], "message": ""}
+    start = time.time()
+    if dry_run:
+        result["plan"] = []
+        lock = None
+    else:
+        lock = SyncLock(tenant.cache_path)
+    if lock and not lock.acquire():
+        result["status"] = "skipped"
+        result["message"] = "A sync is already running"
+        result["elapsed"] = 0.0
+        return result
+
+    try:
+        result["errors"] = run_sync(
+            config=tenant.config(), full_scan=full_scan, plan=result.get("plan"))
+        result["status"] = "complete"
+    except Exception as e:
+        logger.exception("Sync of tenant {} failed".format(tenant.name))
+        result["status"] = "failed"
+        result["message"] = str(e)
+    finally:
+        if lock:
+            lock.release()
+    result["elapsed"] = round(time.time() - start, 1)
+    result["timings"] = metrics.summary()
+    return result
+
+
+def run_tenants(tenants, processes=None, **kwargs):
+    """
+    Sync the tenants on a pool of processes, least recently synced first, so
+    a tenant that missed out on one run goes early in the next.
+
+    Returns the result of each tenant, in the order of `tenants`.
+    """
+    if not tenants:
+        return []
+    ordered = sorted(tenants, key=lambda t: (t.last_synced(), t.name))
+    processes = processes or min(len(tenants), os.cpu_count() or 1)
+    logger.info("Sync {} tenants on {} processes".format(len(tenants), processes))
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(sync_tenant, t, **kwargs): t for t in ordered}
+        for future in as_completed(futures):
+            tenant = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "tenant": tenant.name, "status": "failed", "errors": [],
+                    "message": str(e), "elapsed": 0.0}
+            logger.info("Tenant {}: {} with {} errors in {}s".format(
+                tenant.name, result["status"], len(result["errors"]),
+                result["elapsed"]))
+            results[tenant.name] = result
+    return [results[t.name] for t in tenants]
@@ -1,95 +1,655 @@
 import sys
 import os
+import time
 import logging
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait
 from scoro2clearbooks.scoro import Scoro
-from scoro2clearbooks.clearbooks import ClearBooks
+from scoro2clearbooks.clearbooks import ClearBooks, CustomerIndex, InvoiceIndex
+from scoro2clearbooks.metrics import RunReport, metrics
+from scoro2clearbooks.normalize import name_key
+from scoro2clearbooks.ratelimit import RetryPolicy
+from scoro2clearbooks.records import Invoice
+from scoro2clearbooks.session import HTTPSession
+from scoro2clearbooks.store import Checkpoint, ReferenceStore
 
 logger = logging.getLogger("utils")
 logging.getLogger("requests").setLevel(logging.ERROR)
 logging.getLogger("urllib3").setLevel(logging.ERROR)
 
 
-def run_sync():
+class KeyedLock(object):
+    """
+    Hand out one lock per key, so that work on the same key is serialized.
+    """
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    def lock(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class SyncContext(object):
+    """
+    The clients and shared state used while processing the invoices of a run.
+
+    The reference data is loaded in the background while the first invoices
+    are read, and `loads` maps each name to the future of its load. Reading
+    `customers`, `accounts` or `ledger` waits for that load alone.
+    """
+    def __init__(self, scoro, clearbooks, checkpoint, loads, plan=None, store=None,
+                 started=None):
+        self.scoro = scoro
+        self.clearbooks = clearbooks
+        self.checkpoint = checkpoint
+        self.loads = loads
+        self.store = store
+        self.customer_locks = KeyedLock()
+        # In a dry run the writes are appended to the plan instead
+        self.plan = plan
+        self.planned_customers = set()
+        self.started = started or time.time()
+        self.load_seconds = {}
+        self.first_invoice = None
+        self._first_lock = threading.Lock()
+
+    @property
+    def dry_run(self):
+        return self.plan is not None
+
+    @property
+    def customers(self):
+        return self.wait("customers")
+
+    @property
+    def accounts(self):
+        return self.wait("account_codes")
+
+    @property
+    def ledger(self):
+        return self.wait("ledger")
+
+    def wait(self, name):
+        """
+        The reference data of a name once it has loaded, or None if it is not
+        loaded in this run.
+        """
+        future = self.loads.get(name)
+        return future.result() if future else None
+
+    def check(self):
+        """
+        Raise the error of any reference data that failed to load.
+        """
+        for future in self.loads.values():
+            if future.done() and future.exception():
+                raise future.exception()
+
+    def invoice_done(self):
+        """
+        Note that an invoice has been transferred or planned. The first one
+        completes the startup report.
+        """
+        # Invoices finish on several threads, and only one may report
+        with self._first_lock:
+            if self.first_invoice is not None:
+                return
+            self.first_invoice = time.time() - self.started
+        metrics.observe("sync_first_invoice_seconds", self.first_invoice)
+        logger.info("Startup: first invoice after {:.2f}s; {}".format(
+            self.first_invoice, ", ".join(
+                "{} {:.2f}s".format(name, seconds)
+                for name, seconds in sorted(self.load_seconds.items()))))
+
+    def close(self):
+        # A load may still be using the clients and the store
+        wait(list(self.loads.values()))
+        logger.info("Scoro connections: {}".format(self.scoro.http.stats()))
+        logger.info("Scoro product cache: {}".format(self.scoro.products.stats()))
+        logger.info("ClearBooks connections: {}".format(self.clearbooks.http.stats()))
+        self.scoro.http.close()
+        self.clearbooks.http.close()
+        if self.store:
+            self.store.close()
+        self.checkpoint.close()
+
+
+class Customers(object):
+    """
+    Index of the ClearBooks customers, backed by the reference store.
+    """
+    def __init__(self, clearbooks, store):
+        self.clearbooks = clearbooks
+        self.store = store
+        self._lock = threading.Lock()
+        self.cached = store.fresh("customers")
+        records = store.load("customers", clearbooks.list_customers)
+        # Caches written before customers were indexed map names to ids
+        if not all(isinstance(r, dict) for r in records.values()):
+            records = store.load("customers", clearbooks.list_customers, refresh=True)
+            self.cached = False
+        self.index = self._index(records)
+
+    def _index(self, records):
+        return CustomerIndex(dict(r, id=cust_id) for cust_id, r in records.items())
+
+    def get(self, name, external_id=None):
+        cust_id = self.index.get(name, external_id)
+        if cust_id is None and self.cached:
+            # The cached list may predate customers added in ClearBooks since,
+            # so reload it once before we decide to create a new one
+            with self._lock:
+                if self.cached:
+                    self.index = self._index(self.store.load(
+                        "customers", self.clearbooks.list_customers, refresh=True))
+                    self.cached = False
+            cust_id = self.index.get(name, external_id)
+        return cust_id
+
+    def add(self, cust_id, customer):
+        record = {
+            "company_name": customer.company_name,
+            "external_id": str(customer.external_id or ""),
+        }
+        with self._lock:
+            self.index.add(dict(record, id=cust_id))
+        self.store.put("customers", cust_id, record)
+
+
+class AccountCodes(object):
+    """
+    The ClearBooks account codes by name, backed by the reference store.
+    """
+    def __init__(self, clearbooks, store):
+        self.clearbooks = clearbooks
+        self.store = store
+        self._lock = threading.Lock()
+        self.cached = store.fresh("account_codes")
+        self.codes = store.load("account_codes", clearbooks.list_account_codes)
+
+    def get(self, name, default=None):
+        code = self.codes.get(name)
+        if code is None and self.cached:
+            # An account added in ClearBooks since the list was cached must
+            # not fall back to the default account, so reload it once
+            with self._lock:
+                if self.cached:
+                    self.codes = self.store.load(
+                        "account_codes", self.clearbooks.list_account_codes, refresh=True)
+                    self.cached = False
+            code = self.codes.get(name)
+        return default if code is None else code
+
+
+def run_sync(workers=None, refresh=None, full_scan=None, progress=None, plan=None,
+             config=None):
+    """
+    Transfer the unpaid Scoro invoices to ClearBooks and return the errors.
+
+    Passing a list as `plan` makes it a dry run: everything is read and mapped
+    as usual, but the writes to ClearBooks and Scoro are appended to the plan
+    instead of being made, and the checkpoint is left alone.
+
+    `config` defaults to the one read from the environment.
+    """
     # Get the config file and parse it
-    logger.info("Read config file")
-    config = _read_config()
+    if config is None:
+        logger.info("Read config file")
+        config = _read_config()
+    dry_run = plan is not None
+    if dry_run:
+        # Nothing waits on a write, so let the reads use every connection
+        workers = workers or max(
+            config["sync"]["workers"], config["scoro"]["concurrency"])
+    workers = workers or config["sync"]["workers"]
+    full_scan = full_scan or (full_scan is None and config["sync"]["full_scan"])
+    report = None if dry_run else RunReport(config["sync"]["cache_path"])
+    ctx = open_context(config, refresh=refresh, plan=plan)
+    complete = False
+    try:
+        scoro = ctx.scoro
+        checkpoint = ctx.checkpoint
+        if full_scan and not dry_run:
+            checkpoint.reset()
+
+        # Stream the unpaid invoices changed since the last clean run, skipping
+        # any that an interrupted run already transferred. A dry run leaves the
+        # checkpoint alone, so a full scan ignores it instead.
+        modified_since, skip_done = checkpoint.modified_since, True
+        if dry_run and full_scan:
+            modified_since, skip_done = None, False
+        if not dry_run:
+            checkpoint.begin()
+        invoices = (
+            inv for inv in scoro.invoices(modified_since=modified_since)
+            if not (skip_done and checkpoint.is_done(inv["id"])))
+
+        # Process the Scoro invoices on a pool of workers, a page at a time.
+        # Results are collected in invoice order so the error list reads the same
+        # as a serial run.
+        logger.info("Process invoices with {} workers{}".format(
+            workers, " (dry run)" if dry_run else ""))
+        errors = []
+        done = total = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for batch in _batches(invoices, scoro.per_page):
+                ctx.check()
+                total += len(batch)
+                for error in _process_batch(ctx, pool, batch):
+                    if error:
+                        errors.append(error)
+                    done += 1
+                    if progress:
+                        progress(done=done, total=total, errors=len(errors))
+
+        if not dry_run:
+            checkpoint.finish(clean=len(errors) == 0)
+        complete = True
+    finally:
+        # Also on failure, or a /sync worker leaks connections and threads
+        ctx.close()
+        if report:
+            report.finish(errors if complete else None, ctx.first_invoice)
+    return errors
+
 
-    # Fetch the customers and invoices from ClearBooks
-    clearbooks = ClearBooks(config["clearbooks"]["api_key"])
-    clearbooks_customers = clearbooks.list_customers()
-    clearbooks_accounts = clearbooks.list_account_codes()
+def open_context(config, refresh=None, plan=None):
+    """
+    Connect to Scoro and ClearBooks and start loading the reference data of a
+    run. The loads are independent, so they run concurrently, and the run can
+    start reading invoices without waiting for them.
+    """
+    started = time.time()
+    if refresh is None:
+        refresh = config["sync"]["refresh"]
+    store = ReferenceStore(config["sync"]["cache_path"], refresh=refresh)
+    checkpoint = Checkpoint(config["sync"]["cache_path"])
 
-    # Cache the accounting objects from Scoro
+    cb = config["clearbooks"]
+    clearbooks = ClearBooks(
+        cb["api_key"], concurrency=cb["concurrency"],
+        pool_size=cb["pool_size"], timeout=cb["timeout"], url=cb["url"],
+        rate=cb["rate"], retries=cb["retries"], batch_size=cb["batch_size"])
     c = config["scoro"]
-    scoro = Scoro(c["base_url"], c["company_account_id"], c["api_key"])    
-    scoro.accounting_objects()
+    scoro = Scoro(
+        c["base_url"], c["company_account_id"], c["api_key"],
+        concurrency=c["concurrency"], per_page=c["per_page"],
+        pool_size=c["pool_size"], timeout=c["timeout"], store=store,
+        cache_size=c["cache_size"], cache_ttl=c["cache_ttl"],
+        rate=c["rate"], retries=c["retries"])
+
+    # The customers and account codes from ClearBooks, and the accounting
+    # objects from Scoro, which are cached as they load
+    fetches = {
+        "customers": lambda: Customers(clearbooks, store),
+        "account_codes": lambda: AccountCodes(clearbooks, store),
+        "finance_objects": scoro.accounting_objects,
+    }
+    # Index the invoices already in ClearBooks, so that an invoice created by
+    # an earlier run whose Scoro update failed is not created twice
+    if config["sync"]["reconcile"]:
+        fetches["ledger"] = lambda: _ledger(clearbooks)
+
+    ctx = SyncContext(
+        scoro, clearbooks, checkpoint, {}, plan=plan, store=store, started=started)
+    loader = ThreadPoolExecutor(max_workers=len(fetches))
+    for name, fetch in fetches.items():
+        ctx.loads[name] = loader.submit(_load, ctx, name, fetch)
+    # The threads exit once the loads are done
+    loader.shutdown(wait=False)
+    return ctx
+
+
+def _load(ctx, name, fetch):
+    start = time.time()
+    try:
+        return fetch()
+    except Exception:
+        logger.exception("Error loading {}".format(name))
+        raise
+    finally:
+        ctx.load_seconds[name] = time.time() - start
+        metrics.observe("sync_startup_seconds", ctx.load_seconds[name], load=name)
+
+
+def _ledger(clearbooks):
+    ledger = InvoiceIndex(clearbooks.iter_invoices())
+    logger.info("Found {} invoices in ClearBooks".format(len(ledger)))
+    return ledger
 
-    # Fetch the unpaid invoices from Scoro
-    invoices = scoro.invoices()
-    # for inv in invoices:
-    #     print(inv["no"])
-    # return
 
-    # Process each of the Scoro invoices
+def sync_invoices(ctx, pool, invoice_ids):
+    """
+    Transfer particular Scoro invoices, e.g. those named by webhook events.
+    Invoices that no longer need transferring are skipped.
+
+    Returns an error record or None for each invoice, in order.
+    """
     errors = []
-    for inv in invoices:
+    stubs = ({"id": invoice_id, "no": invoice_id} for invoice_id in invoice_ids)
+    for batch in _batches(stubs, ctx.scoro.per_page):
+        errors.extend(_process_batch(ctx, pool, batch))
+    return errors
+
+
+def _batches(records, size):
+    """
+    Group a stream of records into lists of at most `size` records.
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+class InvoiceWork(object):
+    """
+    The state of one Scoro invoice as it moves through the stages of a batch.
+    """
+    def __init__(self, inv):
+        self.inv = inv
+        self.invoice = None
+        self.customer = None
+        self.customer_name = None
+        self.customer_id = None
+        self.cb_invoice = None
+        self.cb_number = None
+        self.repaired = False
+        self.skipped = False
+        self.error = None
+
+    @property
+    def active(self):
+        """
+        Neither failed nor found to be transferred already.
+        """
+        return self.error is None and not self.skipped
+
+    @property
+    def pending(self):
+        """
+        Still to be created in ClearBooks.
+        """
+        return self.active and not self.repaired
+
+    def fail(self, e):
+        if self.error is None:
+            logger.error("Error processing invoice {}: {}".format(self.inv["no"], e))
+            metrics.inc("sync_invoices_total", status="error")
+            self.error = {"invoice": self.inv["no"], "error": str(e)}
+
+
+def _each(pool, stage, work, step):
+    """
+    Run a step for each invoice concurrently, recording any failure against
+    the invoice.
+    """
+    def run(w):
         try:
-            logger.info("Process invoice {}".format(inv["no"]))
+            with metrics.timer("sync_stage_seconds", stage=stage):
+                step(w)
+        except Exception as e:
+            w.fail(e)
 
-            # Get the full invoice details
-            invoice = scoro.invoice(inv["id"])
+    list(pool.map(run, work))
 
-            # Fetch the customer from Scoro
-            customer = scoro.contact(invoice["company_id"])
 
-            # Check if the customer is already on Clearbooks
-            cust_name = customer["name"].replace("&amp;", "&").replace("&#039;", "'")
-            if clearbooks_customers.get(cust_name):
-                cb_cust_id = clearbooks_customers.get(cust_name)
-            else:
-                # Create the customer in ClearBooks
-                logger.info("Create the ClearBooks customer")
-                cb_customer = scoro.clearbooks_customer(customer)
-
-                cb_cust_id = clearbooks.create_customer(cb_customer)
-                clearbooks_customers[cust_name] = cb_cust_id
-
-            # Get the invoice project
-            if invoice.get("project_id", "0") != "0":
-                logger.info("Get the project")
-                project = scoro.project(invoice.get("project_id"))
-                if project:
-                    invoice["project_code"] = project.get("project_name", "")
-                    invoice["project_name"] = project.get("description", "")
+def _process_batch(ctx, pool, batch):
+    """
+    Transfer a batch of Scoro invoices to ClearBooks, one stage at a time so
+    that the ClearBooks writes of the batch can go out together.
+
+    Returns an error record or None for each invoice, in order.
+    """
+    scoro = ctx.scoro
+    clearbooks = ctx.clearbooks
+    work = [InvoiceWork(inv) for inv in batch]
+    for w in work:
+        logger.info("Process invoice {}".format(w.inv["no"]))
+
+    # Read the full invoices, then load every product they use in bulk so
+    # that mapping the lines is in-memory work
+    def fetch_invoice(w):
+        w.invoice = scoro.invoice(w.inv["id"])
+        if not isinstance(w.invoice, Invoice):
+            raise ValueError(w.invoice or "Invoice not found")
+        w.inv.update(no=w.invoice.no, date=w.invoice.date)
+        # It may have been transferred since it was listed or queued
+        if not scoro.needs_transfer(w.invoice):
+            logger.info("Invoice {} is already transferred".format(w.inv["no"]))
+            metrics.inc("sync_invoices_total", status="skipped")
+            w.skipped = True
+    _each(pool, "invoice", work, fetch_invoice)
+
+    with metrics.timer("sync_stage_seconds", stage="prefetch_products"):
+        _prefetch_products(scoro, [w.invoice for w in work if w.active])
+
+    # Fetch the customers from Scoro and make sure they are on ClearBooks
+    def fetch_contact(w):
+        w.customer = scoro.contact(w.invoice.company_id)
+        w.customer_name = scoro.customer_name(w.customer)
+    pending = [w for w in work if w.pending]
+    _each(pool, "contact", pending, fetch_contact)
+    with metrics.timer("sync_stage_seconds", stage="create_customers"):
+        _resolve_customers(ctx, [w for w in pending if w.pending])
+
+    # Invoices already in ClearBooks for the same customer only need their
+    # back-reference repaired
+    if ctx.ledger:
+        for w in work:
+            existing = ctx.ledger.get(w.invoice.no, w.customer_id) if w.pending else None
+            if existing:
+                logger.info("Invoice {} is already in ClearBooks".format(w.inv["no"]))
+                w.cb_number = existing["invoice_number"]
+                w.repaired = True
+
+    # The lines are mapped by their accounting objects, so wait for those
+    ctx.wait("finance_objects")
+
+    # Get the invoice project and map the fields
+    def map_invoice(w):
+        invoice = w.invoice
+        project = None
+        if invoice.project_id != "0":
+            logger.info("Get the project")
+            project = scoro.project(invoice.project_id)
+        with_project(invoice, project)
+        w.cb_invoice = scoro.clearbooks_invoice(w.customer_id, invoice, ctx.accounts)
+    _each(pool, "map_invoice", [w for w in work if w.pending], map_invoice)
+
+    if ctx.dry_run:
+        _plan_invoices(ctx, work)
+        return [w.error for w in work]
+
+    # Create the invoices in ClearBooks
+    pending = [w for w in work if w.pending]
+    if pending:
+        logger.info("Create {} invoices in ClearBooks".format(len(pending)))
+        with metrics.timer("sync_stage_seconds", stage="create_invoices"):
+            results = clearbooks.create_invoices([w.cb_invoice for w in pending])
+        for w, (cb_inv, error) in zip(pending, results):
+            if error:
+                w.fail(error)
+                continue
+            w.cb_number = cb_inv["invoice_number"]
+            if ctx.ledger is not None:
+                ctx.ledger.add(dict(cb_inv, entity_id=w.customer_id))
+
+    # Update the Scoro invoices to show that they have been processed
+    def update_invoice(w):
+        logger.info("Update the Scoro invoice")
+        scoro.update_invoice(w.invoice, w.cb_number)
+        ctx.checkpoint.done(w.inv["id"], w.inv.get("date"))
+        metrics.inc("sync_invoices_total", status="repaired" if w.repaired else "ok")
+        ctx.invoice_done()
+    _each(pool, "update_invoice", [w for w in work if w.active], update_invoice)
+
+    return [w.error for w in work]
+
+
+def with_project(invoice, project):
+    """
+    Copy the project code and name, if any, onto the invoice for mapping.
+    """
+    if project:
+        invoice.project_code = project.project_name
+        invoice.project_name = project.description
+    elif invoice.project_id == "0":
+        invoice.project_name = ""
+
+
+def _plan_invoices(ctx, work):
+    """
+    Record the invoice writes that a real run would make for a batch.
+    """
+    for w in work:
+        if not w.active:
+            continue
+        if w.pending:
+            ctx.plan.append({
+                "action": "create_invoice",
+                "invoice": w.inv["no"],
+                "customer": w.customer_name,
+                "clearbooks": w.cb_invoice.as_dict(),
+            })
+        ctx.plan.append({
+            "action": "update_invoice",
+            "invoice": w.inv["no"],
+            "clearbooks_number": w.cb_number,
+        })
+        metrics.inc("sync_invoices_total", status="planned")
+        ctx.invoice_done()
+
+
+def _prefetch_products(scoro, invoices):
+    """
+    Bulk load the products used by a batch of invoices. Any failure is left
+    for the per-invoice lookups to retry and report.
+    """
+    product_ids = set()
+    for invoice in invoices:
+        if isinstance(invoice, Invoice):
+            for l in invoice.lines:
+                product_ids.add(l.product_id)
+    try:
+        scoro.prefetch_products(product_ids)
+    except Exception as e:
+        logger.error("Error prefetching products: {}".format(e))
+
+
+def _resolve_customers(ctx, work):
+    """
+    Find the ClearBooks customer of each invoice, creating the missing ones
+    together. Creation is serialized per normalized customer name, so
+    concurrent batches cannot create the same customer twice.
+    """
+    by_key = {}
+    for w in work:
+        by_key.setdefault(name_key(w.customer_name), []).append(w)
+
+    # Take the locks in a fixed order so batches cannot deadlock
+    locks = [ctx.customer_locks.lock(key) for key in sorted(by_key)]
+    for lock in locks:
+        lock.acquire()
+    try:
+        missing = []
+        for key, invoices in by_key.items():
+            first = invoices[0]
+            cust_id = ctx.customers.get(first.customer_name, first.customer.contact_id)
+            if cust_id:
+                for w in invoices:
+                    w.customer_id = cust_id
             else:
-                invoice["project_name"] = ""
+                missing.append(key)
 
-            # Map fields and create the invoice in ClearBooks
-            logger.info("Create the invoice in ClearBooks")
-            cb_invoice = scoro.clearbooks_invoice(cb_cust_id, invoice, clearbooks_accounts)
+        cb_customers = []
+        for key in list(missing):
+            try:
+                cb_customers.append(ctx.scoro.clearbooks_customer(by_key[key][0].customer))
+            except Exception as e:
+                missing.remove(key)
+                for w in by_key[key]:
+                    w.fail(e)
+        if not missing:
+            return
 
-            cb_inv = clearbooks.create_invoice(cb_invoice)
+        if ctx.dry_run:
+            for key, customer in zip(missing, cb_customers):
+                if key not in ctx.planned_customers:
+                    ctx.planned_customers.add(key)
+                    ctx.plan.append({
+                        "action": "create_customer",
+                        "customer": customer.company_name,
+                        "clearbooks": customer.as_dict(),
+                    })
+            return
 
-            # Update the Scoro invoice to show that it has been processed
-            logger.info("Update the Scoro invoice")
-            response = scoro.update_invoice(invoice, cb_inv["invoice_number"])
+        logger.info("Create {} ClearBooks customers".format(len(missing)))
+        results = ctx.clearbooks.create_customers(cb_customers)
+        for key, customer, (cust_id, error) in zip(missing, cb_customers, results):
+            if not error:
+                ctx.customers.add(cust_id, customer)
+            for w in by_key[key]:
+                if error:
+                    w.fail(error)
+                else:
+                    w.customer_id = cust_id
+    finally:
+        for lock in locks:
+            lock.release()
 
-        except Exception as e:
-            logger.error("Error processing invoice {}: {}".format(inv["no"], e))
-            errors.append({"invoice": inv["no"], "error": str(e)})
 
-    return errors
+def _env_int(env, name, default, convert=int):
+    try:
+        return convert(env.get(name, default))
+    except ValueError:
+        logger.error("Invalid value for {}, using {}".format(name, default))
+        return default
 
 
-def _read_config():
+def _read_config(env=None):
+    """
+    Read the settings from the environment, or from a mapping of the same
+    variables.
+    """
+    if env is None:
+        env = os.environ
     return {
         "scoro": {
-            "base_url": os.environ.get("SCORO_BASE_URL", "url_not_set/"),
-            "api_key": os.environ.get("SCORO_API_KEY", "api_not_set"),
-            "lang": os.environ.get("SCORO_LANG", "eng"),
-            "company_account_id": os.environ.get("SCORO_ACCOUNT_ID", "account_id"),
+            "base_url": env.get("SCORO_BASE_URL", "url_not_set/"),
+            "api_key": env.get("SCORO_API_KEY", "api_not_set"),
+            "lang": env.get("SCORO_LANG", "eng"),
+            "company_account_id": env.get("SCORO_ACCOUNT_ID", "account_id"),
+            "concurrency": _env_int(env, "SCORO_CONCURRENCY", Scoro.CONCURRENCY),
+            "per_page": _env_int(env, "SCORO_PER_PAGE", Scoro.PER_PAGE),
+            "pool_size": _env_int(env, "SCORO_POOL_SIZE", 0),
+            "timeout": _env_int(env, "SCORO_TIMEOUT", HTTPSession.TIMEOUT),
+            "cache_size": _env_int(env, "SCORO_CACHE_SIZE", Scoro.CACHE_SIZE),
+            "cache_ttl": _env_int(env, "SCORO_CACHE_TTL", 0),
+            "rate": _env_int(env, "SCORO_RATE", Scoro.RATE, float),
+            "retries": _env_int(env, "SCORO_RETRIES", RetryPolicy.RETRIES),
         },
         "clearbooks": {
-            "api_key": os.environ.get("CLEARBOOKS_API_KEY", "api_not_set"),
+            "api_key": env.get("CLEARBOOKS_API_KEY", "api_not_set"),
+            "url": env.get("CLEARBOOKS_URL", ClearBooks.URL),
+            "concurrency": _env_int(env, "CLEARBOOKS_CONCURRENCY", ClearBooks.CONCURRENCY),
+            "pool_size": _env_int(env, "CLEARBOOKS_POOL_SIZE", 0),
+            "timeout": _env_int(env, "CLEARBOOKS_TIMEOUT", HTTPSession.TIMEOUT),
+            "rate": _env_int(env, "CLEARBOOKS_RATE", ClearBooks.RATE, float),
+            "retries": _env_int(env, "CLEARBOOKS_RETRIES", RetryPolicy.RETRIES),
+            "batch_size": _env_int(env, "CLEARBOOKS_BATCH_SIZE", ClearBooks.BATCH_SIZE),
+        },
+        "sync": {
+            "workers": _env_int(env, "SYNC_WORKERS", 1),
+            "cache_path": env.get("SYNC_CACHE_PATH"),
+            "full_scan": env.get("SYNC_FULL_SCAN") == "1",
+            "reconcile": env.get("SYNC_RECONCILE", "1") == "1",
+            "refresh": [
+                t for t in env.get("SYNC_REFRESH", "").split(",") if t],
         },
     }
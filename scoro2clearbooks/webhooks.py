@@ -0,0 +1,208 @@
+"""
+Transfer invoices as Scoro reports them created or modified, instead of
+waiting for the nightly sync.
+
+Scoro posts an event such as
+
+    {"object": "invoice", "action": "modified", "object_id": 123}
+
+and the invoice id is queued. Queued ids are synced a few seconds later
+through the same batch pipeline as `run_sync`, so a burst of edits to one
+invoice costs a single transfer.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from scoro2clearbooks.jobs import SyncLock
+from scoro2clearbooks.metrics import metrics
+from scoro2clearbooks.store import connect, default_path
+from scoro2clearbooks.utils import open_context, sync_invoices, _read_config
+
+
+logger = logging.getLogger("webhooks")
+
+
+OBJECTS = ("invoice", "invoices")
+ACTIONS = ("create", "created", "modify", "modified")
+
+
+def invoice_event(event):
+    """
+    The invoice id named by an invoice create or modify event, or None for
+    any other event.
+    """
+    if not isinstance(event, dict):
+        return None
+    if event.get("object") not in OBJECTS or event.get("action") not in ACTIONS:
+        return None
+    data = event.get("data")
+    invoice_id = event.get("object_id") or (data.get("id") if isinstance(data, dict) else None)
+    return str(invoice_id) if invoice_id else None
+
+
+class EventQueue(object):
+    """
+    Invoice ids waiting to be synced, kept in SQLite so that every web worker
+    shares one queue. An id that is already queued is not added again.
+    """
+    # Seconds to let a burst of edits settle before syncing
+    DELAY = 5
+    RETRY = 60
+    ATTEMPTS = 5
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._lock = threading.Lock()
+        self.db = connect(self.path)
+        with self._lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_events ("
+                "invoice_id TEXT PRIMARY KEY, received REAL, due REAL, attempts INTEGER)")
+
+    def add(self, invoice_id):
+        """
+        Queue an invoice, returning False if it was already queued.
+        """
+        now = time.time()
+        with self._lock, self.db:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO webhook_events VALUES (?, ?, ?, 0)",
+                (str(invoice_id), now, now + self.DELAY))
+        metrics.inc("webhook_events_total", status="queued" if cursor.rowcount else "duplicate")
+        return bool(cursor.rowcount)
+
+    def due(self, limit):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT invoice_id FROM webhook_events WHERE due <= ? "
+                "ORDER BY due LIMIT ?", (time.time(), limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def wait(self):
+        """
+        Seconds until the next invoice is due, or None if the queue is empty.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT MIN(due) FROM webhook_events").fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def done(self, invoice_id):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM webhook_events WHERE invoice_id=?", (invoice_id,))
+
+    def failed(self, invoice_id, error):
+        """
+        Back off before trying an invoice again. After the last attempt it is
+        left for the nightly sync.
+        """
+        with self._lock, self.db:
+            row = self.db.execute(
+                "SELECT attempts FROM webhook_events WHERE invoice_id=?",
+                (invoice_id,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if attempts >= self.ATTEMPTS:
+                logger.error("Giving up on invoice {}: {}".format(invoice_id, error))
+                self.db.execute(
+                    "DELETE FROM webhook_events WHERE invoice_id=?", (invoice_id,))
+            else:
+                self.db.execute(
+                    "UPDATE webhook_events SET attempts=?, due=? WHERE invoice_id=?",
+                    (attempts, time.time() + self.RETRY * 2 ** (attempts - 1), invoice_id))
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+
+
+class WebhookWorker(object):
+    """
+    Sync the queued invoices in a background thread, started on the first
+    event. The clients and reference data are kept between events, and
+    reloaded once they are `REFRESH` seconds old or after `IDLE` seconds with
+    nothing to do.
+    """
+    IDLE = 5 * 60
+    REFRESH = 60 * 60
+    # Seconds to wait for a running sync, which may pick the invoices up too
+    BUSY = 30
+
+    def __init__(self, queue, config=None):
+        self.queue = queue
+        self.config = config
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ctx = None
+        self._pool = None
+        self._opened = 0
+
+    def submit(self, invoice_id):
+        added = self.queue.add(invoice_id)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="webhooks")
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake.set()
+        return added
+
+    def _run(self):
+        while True:
+            try:
+                wait = self.queue.wait()
+                if wait is None or wait > 0:
+                    if not self._wake.wait(self.IDLE if wait is None else wait) and wait is None:
+                        self._close()
+                    self._wake.clear()
+                    continue
+                self._drain()
+            except Exception:
+                logger.exception("Webhook worker error")
+                self._close()
+                time.sleep(self.BUSY)
+
+    def _drain(self):
+        lock = SyncLock(self.queue.path)
+        if not lock.acquire():
+            time.sleep(self.BUSY)
+            return
+        try:
+            ctx = self._context()
+            # Contacts and projects may have changed since the last events
+            ctx.scoro.clear_lookups()
+            invoice_ids = self.queue.due(ctx.scoro.per_page)
+            logger.info("Sync {} invoices from webhook events".format(len(invoice_ids)))
+            try:
+                with metrics.timer("webhook_sync_seconds"):
+                    errors = sync_invoices(ctx, self._pool, invoice_ids)
+            except Exception as e:
+                # Such as a failed reference data load. Back the whole batch
+                # off, so an outage ends in the nightly sync rather than a
+                # reload every few seconds; `_run` then waits before reopening
+                for invoice_id in invoice_ids:
+                    self.queue.failed(invoice_id, str(e))
+                raise
+            for invoice_id, error in zip(invoice_ids, errors):
+                if error:
+                    self.queue.failed(invoice_id, error["error"])
+                else:
+                    self.queue.done(invoice_id)
+        finally:
+            lock.release()
+
+    def _context(self):
+        if self._ctx and time.time() - self._opened > self.REFRESH:
+            self._close()
+        if self._ctx is None:
+            config = self.config or _read_config()
+            self._ctx = open_context(config)
+            self._pool = ThreadPoolExecutor(max_workers=config["sync"]["workers"])
+            self._opened = time.time()
+        return self._ctx
+
+    def _close(self):
+        if self._ctx:
+            self._pool.shutdown()
+            self._ctx.close()
+            self._ctx = self._pool = None
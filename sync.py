@@ -1,17 +1,116 @@
 #!/usr/bin/env python
+import os
+import sys
+import json
 import logging
+import argparse
+from collections import Counter
 from scoro2clearbooks.utils import run_sync
+from scoro2clearbooks.jobs import SyncLock
+from scoro2clearbooks.metrics import metrics
+from scoro2clearbooks.tenants import load_tenants, run_tenants
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logger = logging.getLogger("sync")
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
-errors = run_sync()
+parser = argparse.ArgumentParser(description="Transfer Scoro invoices to ClearBooks")
+parser.add_argument(
+    "--dry-run", action="store_true",
+    help="read and map everything, but write the plan instead of syncing")
+parser.add_argument(
+    "--plan", default="-",
+    help="file for the dry run plan as JSON, - for stdout (default)")
+parser.add_argument(
+    "--full-scan", action="store_true", default=None,
+    help="consider every unpaid invoice, not only those changed since the last run")
+parser.add_argument(
+    "--async", dest="use_async", action="store_true", default=None,
+    help="run the sync on asyncio (default $SYNC_ASYNC=1); "
+         "dry runs and tenant syncs are always threaded")
+parser.add_argument(
+    "--tenants", default=os.environ.get("SYNC_TENANTS"),
+    help="JSON file listing the accounts to sync (default $SYNC_TENANTS)")
+parser.add_argument(
+    "--processes", type=int, default=int(os.environ.get("SYNC_PROCESSES", 0)),
+    help="number of tenants to sync at once (default: one per CPU)")
+args = parser.parse_args()
 
-if len(errors) == 0:
-    logger.info("Complete")
-else:
+if args.use_async and (args.dry_run or args.tenants):
+    parser.error("--async cannot be combined with --dry-run or --tenants")
+if args.use_async is None:
+    args.use_async = os.environ.get("SYNC_ASYNC") == "1"
+    if args.use_async and (args.dry_run or args.tenants):
+        logger.warning("SYNC_ASYNC is ignored: dry runs and tenant syncs are threaded")
+        args.use_async = False
+
+
+def error_messages(errors):
     messages = ""
     for e in errors:
         messages += "INV{}: {}\n".format(e["invoice"], e["error"])
-    logger.info("Complete with {} errors\n{}".format(len(errors), messages))
+    return messages
+
+
+def write_plan(report):
+    out = sys.stdout if args.plan == "-" else open(args.plan, "w")
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write("\n")
+    if out is not sys.stdout:
+        out.close()
+
+
+def plan_summary(plan, errors):
+    counts = Counter(p["action"] for p in plan)
+    return "{} customers and {} invoices to create, {} Scoro invoices to update, {} errors".format(
+        counts["create_customer"], counts["create_invoice"],
+        counts["update_invoice"], len(errors))
+
+
+if args.tenants:
+    # Each tenant takes its own lock, so there is no global one
+    results = run_tenants(
+        load_tenants(args.tenants), processes=args.processes,
+        full_scan=args.full_scan, dry_run=args.dry_run)
+    if args.dry_run:
+        write_plan({"tenants": results})
+    for r in results:
+        if args.dry_run and r["status"] == "complete":
+            summary = plan_summary(r["plan"], r["errors"])
+        else:
+            summary = "{} with {} errors{}".format(
+                r["status"], len(r["errors"]),
+                ": " + r["message"] if r["message"] else "")
+        logger.info("Tenant {} ({}s): {}\n{}".format(
+            r["tenant"], r["elapsed"], summary, error_messages(r["errors"])))
+    sys.exit(0)
+
+if args.dry_run:
+    # A dry run makes no writes, so it does not need to wait for a real sync
+    plan = []
+    errors = run_sync(full_scan=args.full_scan, plan=plan)
+    write_plan({"plan": plan, "errors": errors})
+    logger.info("Dry run: {}".format(plan_summary(plan, errors)))
+    logger.info("Timings\n{}".format(metrics.summary()))
+    sys.exit(0)
+
+lock = SyncLock(os.environ.get("SYNC_CACHE_PATH"))
+if not lock.acquire():
+    logger.info("A sync is already running")
+    sys.exit(0)
+
+if args.use_async:
+    # Imported here so the threaded sync does not need aiohttp
+    from scoro2clearbooks.aio import run_sync
+
+try:
+    errors = run_sync(full_scan=args.full_scan)
+finally:
+    lock.release()
+
+if len(errors) == 0:
+    logger.info("Complete")
+else:
+    logger.info("Complete with {} errors\n{}".format(len(errors), error_messages(errors)))
+
+logger.info("Timings\n{}".format(metrics.summary()))
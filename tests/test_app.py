@@ -0,0 +1,65 @@
+"""
+The web app: importing the package and serving the routes.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+
+
+class AppTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_import_leaves_database_alone(self):
+        env = dict(os.environ, OPENSHIFT_DATA_DIR=self.dir)
+        env.pop("SYNC_CACHE_PATH", None)
+        subprocess.check_call(
+            [sys.executable, "-c", "import scoro2clearbooks.utils"], env=env)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_webhook_queues_invoice(self):
+        import scoro2clearbooks
+        path = os.path.join(self.dir, "sync.db")
+        env = {"SYNC_CACHE_PATH": path, "SCORO_WEBHOOK_TOKEN": "secret"}
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(scoro2clearbooks, "_webhooks", None), \
+                mock.patch("scoro2clearbooks.webhooks.WebhookWorker.submit",
+                                    autospec=True) as submit:
+            client = scoro2clearbooks.app.test_client()
+            event = {"object": "invoice", "action": "modified", "object_id": 7}
+            # Flask 0.11 has no json= argument
+            body = {"data": json.dumps(event), "content_type": "application/json"}
+            self.assertEqual(client.post("/webhook/scoro", **body).status_code, 403)
+            response = client.post("/webhook/scoro?token=secret", **body)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(submit.call_args[0][1], "7")
+            self.assertEqual(scoro2clearbooks.get_webhooks().queue.path, path)
+
+    def test_metrics_include_other_processes(self):
+        import scoro2clearbooks
+        from scoro2clearbooks.metrics import Metrics, SharedMetrics
+        path = os.path.join(self.dir, "sync.db")
+        # The nightly sync, say, in a process of its own
+        cron = Metrics()
+        cron.inc("sync_invoices_total", 3, status="ok")
+        shared = SharedMetrics(path)
+        cron.flush(shared)
+        shared.record_run(cron, "complete", 60.0)
+        shared.close()
+        with mock.patch.dict(os.environ, {"SYNC_CACHE_PATH": path}), \
+                mock.patch.object(scoro2clearbooks, "_shared_metrics", None):
+            text = scoro2clearbooks.app.test_client().get("/metrics").data.decode("utf-8")
+        self.assertIn('sync_invoices_total{status="ok"} 3\n', text)
+        self.assertIn("sync_last_run_seconds 60.0\n", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
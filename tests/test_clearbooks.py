@@ -0,0 +1,40 @@
+"""
+Index the ClearBooks records a sync looks up.
+"""
+import unittest
+
+from scoro2clearbooks.clearbooks import InvoiceIndex
+
+
+class InvoiceIndexTest(unittest.TestCase):
+    def test_matches_sync_invoice_for_customer(self):
+        index = InvoiceIndex([
+            {"invoice_prefix": "INV", "invoice_number": "10001", "entity_id": "7"}])
+        self.assertEqual(index.get(10001, 7)["invoice_number"], "10001")
+        self.assertEqual(index.get("10001", "7")["invoice_number"], "10001")
+
+    def test_ignores_other_prefixes(self):
+        index = InvoiceIndex([
+            {"invoice_prefix": "CN", "invoice_number": "10001", "entity_id": "7"},
+            {"invoice_prefix": "PO", "invoice_number": "0010001", "entity_id": "7"}])
+        self.assertIsNone(index.get(10001, 7))
+
+    def test_keeps_leading_zeros(self):
+        index = InvoiceIndex([
+            {"invoice_prefix": "INV", "invoice_number": "0010001", "entity_id": "7"}])
+        self.assertIsNone(index.get(10001, 7))
+        self.assertIsNotNone(index.get("0010001", 7))
+
+    def test_number_given_with_prefix(self):
+        index = InvoiceIndex([
+            {"invoice_prefix": "INV", "invoice_number": "INV10001", "entity_id": "7"}])
+        self.assertIsNotNone(index.get(10001, 7))
+
+    def test_ignores_other_customers(self):
+        index = InvoiceIndex([
+            {"invoice_prefix": "INV", "invoice_number": "10001", "entity_id": "8"}])
+        self.assertIsNone(index.get(10001, 7))
+
+
+if __name__ == "__main__":
+    unittest.main()
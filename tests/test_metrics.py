@@ -0,0 +1,56 @@
+"""
+Add up the metrics of several processes in the sync database.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from scoro2clearbooks.metrics import Metrics, SharedMetrics
+
+
+class SharedMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shared = SharedMetrics(os.path.join(self.dir, "sync.db"))
+
+    def tearDown(self):
+        self.shared.close()
+        shutil.rmtree(self.dir)
+
+    def test_processes_add_up(self):
+        # Two web workers, say, each flushing on the scrapes they serve
+        first, second = Metrics(), Metrics()
+        first.inc("sync_invoices_total", 2, status="ok")
+        first.observe("scoro_request_seconds", 0.02, method="invoices")
+        first.flush(self.shared)
+        second.inc("sync_invoices_total", 3, status="ok")
+        second.observe("scoro_request_seconds", 0.2, method="invoices")
+        second.flush(self.shared)
+        # A flush only adds what is new since the last one
+        first.inc("sync_invoices_total", 1, status="ok")
+        first.flush(self.shared)
+        second.flush(self.shared)
+
+        registry = self.shared.registry()
+        self.assertEqual(
+            registry.counters[("sync_invoices_total", (("status", "ok"),))], 6)
+        h = registry.histograms[("scoro_request_seconds", (("method", "invoices"),))]
+        self.assertEqual(h["count"], 2)
+        self.assertAlmostEqual(h["sum"], 0.22)
+        self.assertEqual(h["max"], 0.2)
+        self.assertIn('sync_invoices_total{status="ok"} 6\n', self.shared.render())
+
+    def test_last_run_is_published(self):
+        run = Metrics()
+        run.inc("sync_invoices_total", 4, status="ok")
+        self.shared.record_run(run, "complete", 12.5, first_invoice=0.5, errors=1)
+        text = self.shared.render()
+        self.assertIn("sync_last_run_invoices 4\n", text)
+        self.assertIn("sync_last_run_errors 1\n", text)
+        self.assertIn("sync_last_run_failed 0\n", text)
+        self.assertIn('# sync_invoices_total{status="ok"}: 4\n', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+"""
+Map Scoro records to their ClearBooks counterparts.
+"""
+import unittest
+
+from scoro2clearbooks.clearbooks import CustomerIndex
+from scoro2clearbooks.records import Contact
+from scoro2clearbooks.scoro import Scoro
+
+
+class CustomerTest(unittest.TestCase):
+    def setUp(self):
+        self.scoro = Scoro("http://scoro.invalid/api/v2/", "account", "key")
+
+    def test_contact_without_address_keeps_external_id(self):
+        contact = Contact.from_json({
+            "contact_id": 42, "contact_type": "company", "name": "Acme",
+            "addresses": []})
+        customer = self.scoro.clearbooks_customer(contact)
+        self.assertEqual(customer.external_id, 42)
+
+        # A renamed contact is still found by its id
+        index = CustomerIndex([{
+            "id": "7", "company_name": customer.company_name,
+            "external_id": str(customer.external_id)}])
+        self.assertEqual(index.get("Acme Renamed Ltd", contact.contact_id), "7")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Retry ClearBooks calls only when sending them again cannot duplicate a write.
+"""
+import asyncio
+import unittest
+
+import requests
+
+from benchmarks.fakes import FakeClearBooks
+from scoro2clearbooks import metrics
+from scoro2clearbooks.aio import AsyncClearBooks
+from scoro2clearbooks.clearbooks import ClearBooks
+from scoro2clearbooks.ratelimit import reset_buckets
+from scoro2clearbooks.records import ClearBooksInvoice, ClearBooksItem
+
+
+def sales_invoice():
+    return ClearBooksInvoice(
+        invoice_number="10001", entityId="7", dateCreated="2017-01-02",
+        dateDue="2017-02-01", description="Consulting", reference="10001",
+        items=[ClearBooksItem(
+            unitPrice="100.00", quantity="1", description="Day rate",
+            type="1001001", vatRate="0.2")])
+
+
+class FakeClearBooksTest(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        reset_buckets()
+        self.fake = FakeClearBooks().start()
+        self.clearbooks = ClearBooks("key", url=self.fake.url, retries=2, timeout=0.3)
+        self.clearbooks.http.retry.backoff = 0.01
+
+    def tearDown(self):
+        self.clearbooks.http.close()
+        self.fake.stop()
+
+
+class RetryTest(FakeClearBooksTest):
+    def test_create_not_resent_after_server_error(self):
+        self.fake.faults.append(500)
+        with self.assertRaises(Exception):
+            self.clearbooks.create_invoice(sales_invoice())
+        self.assertEqual(self.clearbooks.http.requests, 1)
+        self.assertEqual(self.fake.calls.get("fault"), 1)
+        self.assertEqual(self.fake.invoices, [])
+
+    def test_create_not_resent_after_read_timeout(self):
+        self.fake.faults.append("timeout")
+        with self.assertRaises(requests.Timeout):
+            self.clearbooks.create_invoice(sales_invoice())
+        self.assertEqual(self.clearbooks.http.requests, 1)
+        self.assertEqual(len(self.fake.invoices), 1)
+
+    def test_create_resent_when_throttled(self):
+        self.fake.faults.append(429)
+        created = self.clearbooks.create_invoice(sales_invoice())
+        self.assertEqual(created["invoice_number"], "10001")
+        self.assertEqual(self.clearbooks.http.requests, 2)
+        self.assertEqual(len(self.fake.invoices), 1)
+
+    def test_create_resent_when_unavailable(self):
+        self.fake.faults.append(503)
+        self.clearbooks.create_invoice(sales_invoice())
+        self.assertEqual(self.clearbooks.http.requests, 2)
+        self.assertEqual(len(self.fake.invoices), 1)
+
+        # Every attempt is answered with a 503 until the retries run out
+        self.fake.error_rate = 1.0
+        with self.assertRaises(Exception):
+            self.clearbooks.create_invoice(sales_invoice())
+        self.assertEqual(self.fake.calls.get("error"), 3)
+        self.assertEqual(len(self.fake.invoices), 1)
+
+    def test_list_resent_after_server_error(self):
+        self.fake.faults.append(500)
+        self.clearbooks.list_invoices(None)
+        self.assertEqual(self.clearbooks.http.requests, 2)
+
+
+class AsyncRetryTest(FakeClearBooksTest):
+    def create_invoice(self, invoice):
+        clearbooks = AsyncClearBooks(self.clearbooks)
+        clearbooks.http.retry.backoff = 0.01
+
+        async def create():
+            try:
+                return await clearbooks.create_invoice(invoice)
+            finally:
+                self.requests = clearbooks.http.requests
+                await clearbooks.http.close()
+        return asyncio.get_event_loop().run_until_complete(create())
+
+    def test_create_not_resent_after_server_error(self):
+        self.fake.faults.append(500)
+        with self.assertRaises(Exception):
+            self.create_invoice(sales_invoice())
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(self.fake.invoices, [])
+
+    def test_create_not_resent_after_read_timeout(self):
+        self.fake.faults.append("timeout")
+        with self.assertRaises(asyncio.TimeoutError):
+            self.create_invoice(sales_invoice())
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(len(self.fake.invoices), 1)
+
+    def test_create_resent_when_throttled(self):
+        self.fake.faults.append(429)
+        self.create_invoice(sales_invoice())
+        self.assertEqual(self.requests, 2)
+        self.assertEqual(len(self.fake.invoices), 1)
+
+    def test_create_resent_when_unavailable(self):
+        self.fake.error_rate = 1.0
+        with self.assertRaises(Exception):
+            self.create_invoice(sales_invoice())
+        self.assertEqual(self.requests, 3)
+        self.assertEqual(self.fake.invoices, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
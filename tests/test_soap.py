@@ -0,0 +1,75 @@
+"""
+Serialize the SOAP envelopes sent to ClearBooks.
+"""
+import unittest
+from xml.etree import ElementTree
+
+from scoro2clearbooks import soap
+from scoro2clearbooks.records import (
+    ClearBooksCustomer, ClearBooksInvoice, ClearBooksItem)
+
+
+NS = {"soap": soap.NS_SOAP, "ns1": soap.NS_CLEARBOOKS}
+
+AWKWARD = 'Smith & "Sons" <Ltd>\r\nUnit 2\t£1,000'
+
+
+def sales_invoice(value, lines=1):
+    return ClearBooksInvoice(
+        invoice_number=value, entityId="7", dateCreated="2017-01-02",
+        dateDue="2017-02-01", description=value, reference=value,
+        items=[ClearBooksItem(
+            unitPrice="100.00", quantity="1", description=value,
+            type="1001001", vatRate="0.2") for _ in range(lines)])
+
+
+class EscapeTest(unittest.TestCase):
+    def parse(self, *operations):
+        return ElementTree.fromstring(
+            soap.envelope(AWKWARD, operations).encode("utf-8"))
+
+    def test_invoice_round_trips(self):
+        root = self.parse(soap.invoice(sales_invoice(AWKWARD)))
+        self.assertEqual(root.find(".//ns1:authenticate/apiKey", NS).text, AWKWARD)
+        invoice = root.find(".//ns1:createInvoice/invoice", NS)
+        self.assertEqual(invoice.get("invoice_number"), AWKWARD)
+        self.assertEqual(invoice.find("description").text, AWKWARD)
+        self.assertEqual(invoice.find("reference").text, AWKWARD)
+        self.assertEqual(invoice.find("items/ns1:Item/description", NS).text, AWKWARD)
+
+    def test_customer_round_trips(self):
+        customer = ClearBooksCustomer(**{f: AWKWARD for f in soap.CUSTOMER_FIELDS})
+        root = self.parse(soap.customer(customer))
+        entity = root.find(".//ns1:createEntity/entity", NS)
+        for field in soap.CUSTOMER_FIELDS:
+            self.assertEqual(entity.get(field), AWKWARD)
+
+    def test_query_round_trips(self):
+        root = self.parse(soap.query("listInvoices", [("ledger", AWKWARD)]))
+        self.assertEqual(root.find(".//ns1:listInvoices/query", NS).get("ledger"), AWKWARD)
+
+    def test_missing_values_are_empty(self):
+        root = self.parse(soap.invoice(sales_invoice(None)))
+        invoice = root.find(".//ns1:createInvoice/invoice", NS)
+        self.assertEqual(invoice.get("invoice_number"), "")
+        self.assertIsNone(invoice.find("description").text)
+
+
+class StreamTest(unittest.TestCase):
+    def operations(self):
+        return [
+            soap.customer(ClearBooksCustomer(company_name=AWKWARD)),
+            soap.invoice(sales_invoice(AWKWARD, lines=200)),
+            soap.invoice(sales_invoice("10002", lines=3)),
+        ]
+
+    def test_stream_matches_envelope(self):
+        expected = soap.envelope(AWKWARD, self.operations()).encode("utf-8")
+        for chunk_size in (1, 100, 16 * 1024, 10 ** 6):
+            chunks = list(soap.iter_envelope(AWKWARD, self.operations(), chunk_size))
+            self.assertEqual(b"".join(chunks), expected)
+            self.assertTrue(all(chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,220 @@
+"""
+Run the sync against the local Scoro and ClearBooks stand-ins.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from benchmarks.fakes import FakeScoro, FakeClearBooks
+from scoro2clearbooks.metrics import SharedMetrics, metrics
+from scoro2clearbooks.ratelimit import reset_buckets
+from scoro2clearbooks.store import Checkpoint, ReferenceStore
+from scoro2clearbooks.utils import SyncContext, run_sync, _read_config
+
+try:
+    from scoro2clearbooks import aio
+except ImportError:
+    aio = None
+
+
+class SyncTest(unittest.TestCase):
+    invoices = 5
+
+    def setUp(self):
+        metrics.reset()
+        reset_buckets()
+        self.scoro = FakeScoro(invoices=self.invoices).start()
+        self.clearbooks = FakeClearBooks().start()
+        self.dir = tempfile.mkdtemp()
+        self.env = {
+            "SCORO_BASE_URL": self.scoro.base_url,
+            "CLEARBOOKS_URL": self.clearbooks.url,
+            "SYNC_CACHE_PATH": os.path.join(self.dir, "sync.db"),
+            "SYNC_WORKERS": "4",
+            "SCORO_RETRIES": "0",
+            "CLEARBOOKS_RETRIES": "0",
+        }
+
+    def tearDown(self):
+        self.scoro.stop()
+        self.clearbooks.stop()
+        shutil.rmtree(self.dir)
+
+    def run_sync(self, use_async=False, **kwargs):
+        sync = aio.run_sync if use_async else run_sync
+        return sync(config=_read_config(self.env), **kwargs)
+
+    def modified_since(self):
+        checkpoint = Checkpoint(self.env["SYNC_CACHE_PATH"])
+        try:
+            return checkpoint.modified_since
+        finally:
+            checkpoint.close()
+
+    def test_transfers_invoices(self):
+        self.assertEqual(self.run_sync(), [])
+        self.assertEqual(self.scoro.transferred(), self.invoices)
+        self.assertEqual(self.clearbooks.calls["createInvoice"], self.invoices)
+        self.assertTrue(self.modified_since())
+
+    def test_update_sends_only_the_reference(self):
+        modify = mock.Mock(wraps=self.scoro._invoices_modify)
+        self.scoro._invoices_modify = modify
+        self.assertEqual(self.run_sync(), [])
+        self.assertEqual(modify.call_count, self.invoices)
+        for (record_id, request), kwargs in modify.call_args_list:
+            self.assertEqual(list(request["request"]), ["custom_fields"])
+            self.assertEqual(list(request["request"]["custom_fields"]), ["c_clearbooksref"])
+        # Scoro keeps the custom fields that are not sent
+        self.assertEqual(self.scoro.invoices[1]["custom_fields"]["c_ponumber"], "PO-000001")
+
+    def test_run_is_published(self):
+        self.run_sync()
+        shared = SharedMetrics(self.env["SYNC_CACHE_PATH"])
+        try:
+            run = shared.last_run()
+            self.assertEqual(run["status"], "complete")
+            self.assertEqual(run["invoices"], self.invoices)
+            registry = shared.registry()
+        finally:
+            shared.close()
+        self.assertEqual(
+            registry.counters[("sync_invoices_total", (("status", "ok"),))], self.invoices)
+
+    def test_rejected_update_fails_the_invoice(self):
+        self.scoro.failing.add("invoices/modify")
+        errors = self.run_sync()
+        self.assertEqual(len(errors), self.invoices)
+        self.assertIn("did not update", errors[0]["error"])
+        self.assertEqual(self.scoro.transferred(), 0)
+        # The run is not clean, so the invoices are listed again next time
+        self.assertIsNone(self.modified_since())
+
+    def test_reconcile_repairs_back_reference(self):
+        self.scoro.failing.add("invoices/modify")
+        self.run_sync()
+        self.scoro.failing.clear()
+        self.assertEqual(self.run_sync(), [])
+        self.assertEqual(self.scoro.transferred(), self.invoices)
+        # The second run found the invoices in ClearBooks instead of creating them
+        self.assertEqual(self.clearbooks.calls["createInvoice"], self.invoices)
+
+    def add_lookalike_invoices(self):
+        number = str(self.scoro.invoices[1]["no"])
+        self.clearbooks.invoices.extend([
+            {"invoice_id": "901", "invoice_prefix": "CN", "invoice_number": number,
+             "entity_id": "1", "reference": ""},
+            {"invoice_id": "902", "invoice_number": "00" + number,
+             "entity_id": "1", "reference": ""},
+            {"invoice_id": "903", "invoice_number": number,
+             "entity_id": "999", "reference": ""},
+        ])
+
+    def test_reconcile_ignores_other_documents_with_the_number(self):
+        self.add_lookalike_invoices()
+        self.assertEqual(self.run_sync(), [])
+        self.assertEqual(self.clearbooks.calls["createInvoice"], self.invoices)
+
+    def test_listing_error_fails_the_run(self):
+        self.scoro.failing.add("invoices/list")
+        with self.assertRaises(ValueError):
+            self.run_sync()
+        self.assertEqual(self.clearbooks.calls.get("createInvoice", 0), 0)
+        self.assertIsNone(self.modified_since())
+
+    def test_failed_run_is_published(self):
+        self.scoro.failing.add("invoices/list")
+        with self.assertRaises(ValueError):
+            self.run_sync()
+        shared = SharedMetrics(self.env["SYNC_CACHE_PATH"])
+        try:
+            self.assertEqual(shared.last_run()["status"], "failed")
+        finally:
+            shared.close()
+
+    def test_failed_run_closes_the_context(self):
+        self.scoro.failing.add("invoices/list")
+        with mock.patch.object(SyncContext, "close", autospec=True,
+                               side_effect=SyncContext.close) as close:
+            with self.assertRaises(ValueError):
+                self.run_sync()
+        self.assertEqual(close.call_count, 1)
+
+    def test_accounting_objects_error_is_not_cached(self):
+        self.scoro.failing.add("financeObjects/list")
+        with self.assertRaises(ValueError):
+            self.run_sync()
+        self.scoro.failing.clear()
+        self.assertEqual(self.run_sync(), [])
+        self.assertEqual(self.scoro.calls["financeObjects/list"], 2)
+
+    def test_unknown_account_reloads_cached_codes(self):
+        store = ReferenceStore(self.env["SYNC_CACHE_PATH"])
+        store.replace("account_codes", {"Sales 1": "4001"})
+        store.close()
+        plan = []
+        self.assertEqual(self.run_sync(plan=plan), [])
+        types = {
+            item["type"] for p in plan if p["action"] == "create_invoice"
+            for item in p["clearbooks"]["items"]}
+        self.assertEqual(types, {"4001", "4002", "4003"})
+        self.assertEqual(self.clearbooks.calls["listAccountCodes"], 1)
+
+    def test_catalog_bigger_than_cache_is_listed_once(self):
+        self.scoro.stop()
+        self.scoro = FakeScoro(invoices=self.invoices, lines=50).start()
+        self.env["SCORO_BASE_URL"] = self.scoro.base_url
+        self.env["SCORO_CACHE_SIZE"] = "20"
+        self.env["SCORO_PER_PAGE"] = "2"
+        self.assertEqual(self.run_sync(), [])
+        # One sweep of the ten groups, two to a page
+        self.assertEqual(self.scoro.calls["productGroups/list"], 6)
+        store = ReferenceStore(self.env["SYNC_CACHE_PATH"])
+        try:
+            self.assertEqual(len(store.get("products")), 100)
+        finally:
+            store.close()
+
+    def test_first_invoice_is_reported_once(self):
+        ctx = SyncContext(None, None, None, {})
+        with mock.patch("scoro2clearbooks.utils.metrics.observe") as observe:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(lambda i: ctx.invoice_done(), range(100)))
+        observe.assert_called_once_with("sync_first_invoice_seconds", ctx.first_invoice)
+
+    @unittest.skipIf(aio is None, "aiohttp is not installed")
+    def test_async_rejected_update_fails_the_invoice(self):
+        self.scoro.failing.add("invoices/modify")
+        errors = self.run_sync(use_async=True)
+        self.assertEqual(len(errors), self.invoices)
+        self.assertEqual(self.scoro.transferred(), 0)
+        self.assertIsNone(self.modified_since())
+
+    @unittest.skipIf(aio is None, "aiohttp is not installed")
+    def test_async_reconcile_ignores_other_documents_with_the_number(self):
+        self.add_lookalike_invoices()
+        self.assertEqual(self.run_sync(use_async=True), [])
+        self.assertEqual(self.clearbooks.calls["createInvoice"], self.invoices)
+
+    @unittest.skipIf(aio is None, "aiohttp is not installed")
+    def test_async_listing_error_fails_the_run(self):
+        self.scoro.failing.add("invoices/list")
+        with self.assertRaises(ValueError):
+            self.run_sync(use_async=True)
+        self.assertIsNone(self.modified_since())
+
+    @unittest.skipIf(aio is None, "aiohttp is not installed")
+    def test_async_invoices_share_catalog_sweep(self):
+        # Enough products per invoice to take the bulk path on a cold cache
+        self.scoro.stop()
+        self.scoro = FakeScoro(invoices=self.invoices, lines=50).start()
+        self.env["SCORO_BASE_URL"] = self.scoro.base_url
+        self.assertEqual(self.run_sync(use_async=True), [])
+        self.assertEqual(self.scoro.calls["productGroups/list"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,15 @@
+"""
+Sync several tenants on a pool of processes.
+"""
+import unittest
+
+from scoro2clearbooks.tenants import run_tenants
+
+
+class TenantsTest(unittest.TestCase):
+    def test_no_tenants(self):
+        self.assertEqual(run_tenants([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+Sync the invoices queued by Scoro webhook events.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from scoro2clearbooks.webhooks import EventQueue, WebhookWorker
+
+
+class WebhookWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue = EventQueue(os.path.join(self.dir, "sync.db"))
+        self.queue.DELAY = 0
+
+    def tearDown(self):
+        self.queue.db.close()
+        shutil.rmtree(self.dir)
+
+    def test_failed_batch_backs_off_every_invoice(self):
+        for invoice_id in ("1", "2"):
+            self.queue.add(invoice_id)
+        worker = WebhookWorker(self.queue, config={"sync": {"workers": 1}})
+        ctx = mock.Mock()
+        ctx.scoro.per_page = 40
+        with mock.patch("scoro2clearbooks.webhooks.open_context", return_value=ctx), \
+                mock.patch("scoro2clearbooks.webhooks.sync_invoices",
+                           side_effect=ValueError("ClearBooks is down")):
+            with self.assertRaises(ValueError):
+                worker._drain()
+        worker._close()
+        self.assertEqual(self.queue.due(10), [])
+        attempts = self.queue.db.execute(
+            "SELECT attempts FROM webhook_events ORDER BY invoice_id").fetchall()
+        self.assertEqual(attempts, [(1,), (1,)])
+
+
+if __name__ == "__main__":
+    unittest.main()